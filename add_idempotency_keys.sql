@@ -0,0 +1,19 @@
+-- Migration: Idempotency keys for the purchase endpoints
+-- One row per (user, Idempotency-Key): which endpoint it was used on, a
+-- fingerprint of the request body and the response that was returned.
+-- Rows are written by the purchase transaction itself, so a committed row
+-- always has its response. Old rows are purged by the background sweeper.
+
+CREATE TABLE IF NOT EXISTS IdempotencyKey (
+    user_id INT NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    endpoint VARCHAR(64) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code INT,
+    response TEXT,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT LOCALTIMESTAMP,
+    PRIMARY KEY (user_id, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotencykey_created_at
+ON IdempotencyKey (created_at);
@@ -0,0 +1,26 @@
+-- Migration: Indexes for the paginated, filterable product catalog
+-- Equality filters are paired with product_id DESC so a page is an index
+-- range scan that stops after LIMIT rows, however large the catalog grows.
+
+CREATE INDEX IF NOT EXISTS idx_product_motif_id
+ON Product (cultural_motif, product_id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_product_artisan_id
+ON Product (artisan_id, product_id DESC);
+
+-- A price range cannot be paired that way: within (price, product_id) the
+-- ids are only ordered per price, so the range would still be sorted. Wide
+-- ranges are served by walking the primary key backwards and filtering on
+-- price (stops after LIMIT matches); this plain index serves narrow ranges,
+-- where reading the few matching rows and sorting them is cheaper.
+DROP INDEX IF EXISTS idx_product_price_id;
+
+CREATE INDEX IF NOT EXISTS idx_product_price
+ON Product (price);
+
+-- Only in-stock rows, used when buyers hide sold-out items
+CREATE INDEX IF NOT EXISTS idx_product_in_stock_id
+ON Product (product_id DESC)
+WHERE stock_quantity > 0;
+
+ANALYZE Product;
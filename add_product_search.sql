@@ -0,0 +1,39 @@
+-- Migration: Full-text search over product name, description and motif
+-- The 'english' configuration stems English words; 'simple' keeps every
+-- token as-is so Bangla (and transliterated) words are matched exactly.
+
+ALTER TABLE Product
+ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+CREATE OR REPLACE FUNCTION product_search_vector(
+    p_name TEXT, p_motif TEXT, p_description TEXT
+) RETURNS tsvector AS $$
+    SELECT
+        setweight(to_tsvector('english', COALESCE(p_name, '')), 'A') ||
+        setweight(to_tsvector('simple', COALESCE(p_name, '')), 'A') ||
+        setweight(to_tsvector('english', COALESCE(p_motif, '')), 'B') ||
+        setweight(to_tsvector('simple', COALESCE(p_motif, '')), 'B') ||
+        setweight(to_tsvector('english', COALESCE(p_description, '')), 'C') ||
+        setweight(to_tsvector('simple', COALESCE(p_description, '')), 'C')
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- Keep the column in step with every insert and relevant update
+CREATE OR REPLACE FUNCTION product_search_vector_refresh() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := product_search_vector(NEW.name, NEW.cultural_motif, NEW.description);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_product_search_vector ON Product;
+CREATE TRIGGER trg_product_search_vector
+BEFORE INSERT OR UPDATE OF name, cultural_motif, description ON Product
+FOR EACH ROW EXECUTE FUNCTION product_search_vector_refresh();
+
+-- Backfill existing products
+UPDATE Product
+SET search_vector = product_search_vector(name, cultural_motif, description)
+WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_product_search_vector
+ON Product USING GIN (search_vector);
@@ -0,0 +1,34 @@
+-- Migration: Time-limited stock reservations
+-- Product.reserved_quantity is the sum of the live holds on that product, so
+-- availability is stock_quantity - reserved_quantity without reading the
+-- holds themselves. Both are changed in the same statement.
+
+ALTER TABLE Product
+ADD COLUMN IF NOT EXISTS reserved_quantity INT NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint WHERE conname = 'product_reserved_quantity_check'
+    ) THEN
+        ALTER TABLE Product
+        ADD CONSTRAINT product_reserved_quantity_check CHECK (reserved_quantity >= 0);
+    END IF;
+END$$;
+
+CREATE TABLE IF NOT EXISTS StockReservation (
+    reservation_id SERIAL PRIMARY KEY,
+    product_id INT NOT NULL REFERENCES Product(product_id) ON DELETE CASCADE,
+    customer_id INT NOT NULL REFERENCES Customer(customer_id) ON DELETE CASCADE,
+    quantity INT NOT NULL CHECK (quantity > 0),
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+    expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+-- One hold per buyer and product
+CREATE UNIQUE INDEX IF NOT EXISTS idx_stockreservation_customer_product
+ON StockReservation (customer_id, product_id);
+
+-- The sweeper reads expired holds oldest first
+CREATE INDEX IF NOT EXISTS idx_stockreservation_expires_at
+ON StockReservation (expires_at);
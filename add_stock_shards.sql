@@ -0,0 +1,37 @@
+-- Migration: Sharded stock counters for flash-sale products
+-- A product with stock_shards = N > 0 keeps its stock in N ProductStockSlot
+-- rows instead of Product.stock_quantity (which stays 0), so concurrent
+-- purchases update different rows. total_stock() is the figure to display.
+
+ALTER TABLE Product
+ADD COLUMN IF NOT EXISTS stock_shards INT NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS ProductStockSlot (
+    product_id INT NOT NULL REFERENCES Product(product_id) ON DELETE CASCADE,
+    slot INT NOT NULL,
+    quantity INT NOT NULL CHECK (quantity >= 0),
+    PRIMARY KEY (product_id, slot)
+);
+
+CREATE OR REPLACE FUNCTION total_stock(p Product) RETURNS INT AS $$
+    SELECT CASE WHEN p.stock_shards > 0
+                THEN (SELECT COALESCE(SUM(s.quantity), 0)::int
+                      FROM ProductStockSlot s WHERE s.product_id = p.product_id)
+                ELSE p.stock_quantity
+           END
+$$ LANGUAGE SQL STABLE;
+
+-- The in-stock listing filter also has to keep sharded products, whose
+-- stock_quantity is 0
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_indexes
+        WHERE indexname = 'idx_product_in_stock_id' AND indexdef LIKE '%stock_shards%'
+    ) THEN
+        DROP INDEX IF EXISTS idx_product_in_stock_id;
+        CREATE INDEX idx_product_in_stock_id
+        ON Product (product_id DESC)
+        WHERE stock_quantity > 0 OR stock_shards > 0;
+    END IF;
+END$$;
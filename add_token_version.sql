@@ -0,0 +1,24 @@
+-- Migration: per-user token version for JWT revocation
+-- Tokens carry the version they were issued with; bumping it revokes them.
+-- Safe to run multiple times
+
+ALTER TABLE "User"
+ADD COLUMN IF NOT EXISTS token_version INT NOT NULL DEFAULT 0;
+
+ALTER TABLE "User"
+ADD COLUMN IF NOT EXISTS token_version_updated_at TIMESTAMP WITHOUT TIME ZONE;
+
+-- Workers poll for recently revoked users through this index
+CREATE INDEX IF NOT EXISTS idx_user_token_version_updated_at
+    ON "User"(token_version_updated_at)
+    WHERE token_version_updated_at IS NOT NULL;
+
+-- Deleted users have no row left to bump, so rejecting one leaves a
+-- tombstone that the same poll reads
+CREATE TABLE IF NOT EXISTS RevokedUser (
+    user_id INT PRIMARY KEY,
+    revoked_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_revokeduser_revoked_at
+    ON RevokedUser(revoked_at);
@@ -0,0 +1,108 @@
+"""Micro-benchmark: cost of serializing list-endpoint rows, per 1k rows.
+
+Compares the previous path (per-field float()/isoformat(), response_model
+validation and FastAPI's jsonable_encoder + json.dumps) with FastJSONResponse
+over raw rows. No database is needed; rows are synthesized.
+
+    python bench_json.py [rows] [repeats]
+"""
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, TypeAdapter
+
+import fastjson
+
+
+class ProductDisplay(BaseModel):
+    # Same fields as main.ProductDisplay, kept here so the benchmark does not
+    # import the application
+    product_id: int
+    name: str
+    price: float
+    stock_quantity: int
+    cultural_motif: str
+    artisan_id: int
+    seller_email: Optional[str] = None
+    image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
+    description: Optional[str] = None
+
+
+PRODUCT_COLUMNS = ("product_id", "name", "price", "stock_quantity", "cultural_motif",
+                   "artisan_id", "seller_email", "image_url", "description")
+ORDER_COLUMNS = ("order_id", "order_date", "status", "product_name", "quantity",
+                 "amount", "courier_service", "shipped_date", "tracking_number")
+
+
+def product_rows(n: int, money):
+    return [(i, f"Handwoven Nakshi Kantha {i}", money("2500.00"), i % 17, "Nayantara", 1 + i % 50,
+             f"artisan{i % 50}@uni.edu", f"/uploads/ab/cd/{i:064x}.jpg", "Hand stitched cotton quilt")
+            for i in range(n)]
+
+
+def order_rows(n: int, money):
+    now = datetime(2026, 10, 16, 12, 30, 15, 123456)
+    return [(i, now - timedelta(minutes=i), "Shipped", f"Clay Pottery Set {i}", 1 + i % 3,
+             money("1200.00"), "Uthao", now, f"UT{i:08d}") for i in range(n)]
+
+
+def products_before(rows):
+    data = [{
+        "product_id": r[0], "name": r[1], "price": float(r[2]), "stock_quantity": r[3],
+        "cultural_motif": r[4], "artisan_id": r[5], "seller_email": r[6],
+        "image_url": r[7], "description": r[8]
+    } for r in rows]
+    validated = TypeAdapter(List[ProductDisplay]).validate_python(data)
+    return json.dumps(jsonable_encoder(validated)).encode("utf-8")
+
+
+def products_after(rows):
+    return fastjson.FastJSONResponse(fastjson.rows_to_dicts(PRODUCT_COLUMNS, rows)).body
+
+
+def orders_before(rows):
+    data = [{
+        "order_id": r[0], "order_date": r[1].isoformat(), "status": r[2],
+        "product_name": r[3], "quantity": r[4], "amount": float(r[5]) if r[5] else 0.0,
+        "courier_service": r[6], "shipped_date": r[7].isoformat() if r[7] else None,
+        "tracking_number": r[8]
+    } for r in rows]
+    return json.dumps(jsonable_encoder(data)).encode("utf-8")
+
+
+def orders_after(rows):
+    return fastjson.FastJSONResponse(fastjson.rows_to_dicts(ORDER_COLUMNS, rows)).body
+
+
+def per_1k_ms(fn, rows, repeats: int) -> float:
+    best = min(timeit.repeat(lambda: fn(rows), number=1, repeat=repeats))
+    return best * 1000 * 1000 / len(rows)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    encoder = "orjson" if fastjson.orjson is not None else "json (orjson not installed)"
+    print(f"{n} rows, best of {repeats}, encoder: {encoder}")
+    print(f"{'endpoint':<22}{'before ms/1k':>14}{'after ms/1k':>14}{'speedup':>10}")
+    # The old path saw Decimal money; the new statements cast to float8
+    cases = (
+        ("/products", products_before, product_rows(n, Decimal),
+         products_after, product_rows(n, float)),
+        ("/artisan/orders", orders_before, order_rows(n, Decimal),
+         orders_after, order_rows(n, float)),
+    )
+    for name, before, before_rows, after, after_rows in cases:
+        b = per_1k_ms(before, before_rows, repeats)
+        a = per_1k_ms(after, after_rows, repeats)
+        print(f"{name:<22}{b:>14.2f}{a:>14.2f}{b / a:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
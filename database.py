@@ -1,6 +1,14 @@
+import asyncio
 import os
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import text
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from pathlib import Path
@@ -16,29 +24,480 @@ load_dotenv(dotenv_path=env_path)
 # --- Database Connection Details ---
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Debugging: Print to console so you can see what is happening
-print(f"DEBUG: Looking for .env at: {env_path}")
-print(f"DEBUG: File exists? {env_path.exists()}")
-if DATABASE_URL:
-    print(
-        f"DEBUG: DATABASE_URL found: {DATABASE_URL[:30]}...{DATABASE_URL[-20:]}")
-else:
-    print("DEBUG: DATABASE_URL is EMPTY or NOT FOUND.")
+# --- Connection Pool Settings ---
+# All tunable from the environment. Instead of pinging on every checkout,
+# a connection is only pinged when it has sat idle in the pool for longer
+# than DB_PREPING_IDLE_SECONDS (0 pings every time, negative never pings).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_PREPING_IDLE_SECONDS = float(os.getenv("DB_PREPING_IDLE_SECONDS", "30"))
 
-if not DATABASE_URL:
-    raise Exception(
-        "DATABASE_URL not found in .env file. Please check file name (is it .env.txt?) and location.")
+# Upper bounds (ms) of the checkout latency histogram buckets
+CHECKOUT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
 
-# Create the SQLAlchemy engine
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class PoolStats:
+    """Checkout counters and latency histogram for one connection pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(CHECKOUT_BUCKETS_MS) + 1)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.idle_pings = 0
+        self.stale_connections = 0
+
+    def record_checkout(self, wait_ms: float):
+        index = len(CHECKOUT_BUCKETS_MS)
+        for i, bound in enumerate(CHECKOUT_BUCKETS_MS):
+            if wait_ms <= bound:
+                index = i
+                break
+        with self._lock:
+            self.buckets[index] += 1
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_idle_ping(self):
+        with self._lock:
+            self.idle_pings += 1
+
+    def record_stale_connection(self):
+        with self._lock:
+            self.stale_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            labels = [f"<={b}ms" for b in CHECKOUT_BUCKETS_MS] + ["+Inf"]
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 3),
+                "idle_pings": self.idle_pings,
+                "stale_connections": self.stale_connections,
+                "checkout_latency_histogram": dict(zip(labels, self.buckets))
+            }
+
+
+class _TimedCheckout:
+    """Pool mixin timing how long each checkout waits for a connection."""
+    stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_checkout((time.perf_counter() - start) * 1000)
+        return conn
+
+
+def instrumented_pool(pool_class, stats: PoolStats):
+    # A per-engine subclass, so the stats survive pool.recreate() on dispose.
+    return type(f"Instrumented{pool_class.__name__}", (_TimedCheckout, pool_class), {"stats": stats})
+
+
+def install_idle_preping(engine, stats: PoolStats):
+    """Ping connections on checkout only if they sat idle past the threshold."""
+    if DB_PREPING_IDLE_SECONDS < 0:
+        return
+
+    @event.listens_for(engine, "checkin")
+    def _record_checkin(dbapi_connection, connection_record):
+        connection_record.info["last_checkin"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def _ping_if_idle(dbapi_connection, connection_record, connection_proxy):
+        last_checkin = connection_record.info.get("last_checkin")
+        if last_checkin is None or time.monotonic() - last_checkin < DB_PREPING_IDLE_SECONDS:
+            return
+        stats.record_idle_ping()
+        try:
+            engine.dialect.do_ping(dbapi_connection)
+        except Exception:
+            stats.record_stale_connection()
+            # Makes the pool discard this connection and hand out a new one
+            raise exc.DisconnectionError()
+
+
+def pool_options(pool_class, stats: PoolStats) -> dict:
+    return {
+        "poolclass": instrumented_pool(pool_class, stats),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+
+
+def describe_pool(engine, stats: PoolStats) -> dict:
+    """Live occupancy of an engine's pool plus its checkout statistics."""
+    pool = engine.pool
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout_seconds": DB_POOL_TIMEOUT,
+        "recycle_seconds": DB_POOL_RECYCLE,
+        "preping_idle_seconds": DB_PREPING_IDLE_SECONDS,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        **stats.snapshot()
+    }
+
+
+# --- Lazy Engine Construction ---
+# Engines are built on first use (or during startup warm-up) rather than at
+# import time, so importing this module stays cheap and never touches the
+# network. The sessionmakers are bound per session to the lazily built engine.
+_engine_lock = threading.Lock()
+_engines = {}
+
+engine_stats = PoolStats()
+async_engine_stats = PoolStats()
+replica_engine_stats = PoolStats()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
 
+def require_database_url() -> str:
+    if not DATABASE_URL:
+        raise Exception(
+            "DATABASE_URL not found in .env file. Please check file name (is it .env.txt?) and location.")
+    return DATABASE_URL
+
+
+def _lazy_engine(name: str, build):
+    engine = _engines.get(name)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                engine = build()
+                _engines[name] = engine
+    return engine
+
+
+def _build_engine():
+    engine = create_engine(require_database_url(), **
+                           pool_options(QueuePool, engine_stats))
+    install_idle_preping(engine, engine_stats)
+    return engine
+
+
+def get_engine():
+    """The primary sync engine, built on first use."""
+    return _lazy_engine("sync", _build_engine)
+
+
 def get_db():
-    db = SessionLocal()
+    db = SessionLocal(bind=get_engine())
     try:
         yield db
     finally:
         db.close()
+
+
+# --- Read Replica (optional) ---
+# Heavy read-only GET endpoints can depend on get_read_db instead of get_db
+# to run on DATABASE_REPLICA_URL. If the replica cannot hand out a
+# connection, the request falls back to the primary and the replica is
+# skipped for DB_REPLICA_RETRY_SECONDS. Routes that must see their own
+# writes immediately keep using get_db, which always pins to the primary.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "30"))
+
+
+def _build_replica_engine():
+    engine = create_engine(
+        DATABASE_REPLICA_URL, **pool_options(QueuePool, replica_engine_stats))
+    install_idle_preping(engine, replica_engine_stats)
+    return engine
+
+
+def get_replica_engine():
+    """The replica engine, or None when no replica is configured."""
+    if not DATABASE_REPLICA_URL:
+        return None
+    return _lazy_engine("replica", _build_replica_engine)
+
+
+class ReplicaHealth:
+    """Tracks replica failures so a dead replica is not retried per request."""
+
+    def __init__(self, retry_seconds: float):
+        self.retry_seconds = retry_seconds
+        self._down_until = 0.0
+        self.replica_sessions = 0
+        self.fallbacks = 0
+        self.last_error = None
+
+    def available(self) -> bool:
+        return bool(DATABASE_REPLICA_URL) and time.monotonic() >= self._down_until
+
+    def mark_down(self, error: Exception):
+        self._down_until = time.monotonic() + self.retry_seconds
+        self.last_error = str(error)
+
+    def snapshot(self) -> dict:
+        return {
+            "configured": bool(DATABASE_REPLICA_URL),
+            "available": self.available(),
+            "replica_sessions": self.replica_sessions,
+            "fallbacks_to_primary": self.fallbacks,
+            "last_error": self.last_error
+        }
+
+
+replica_health = ReplicaHealth(DB_REPLICA_RETRY_SECONDS)
+
+
+def get_read_db():
+    """Read-only session on the replica when available, else on the primary."""
+    db = None
+    if replica_health.available():
+        db = SessionLocal(bind=get_replica_engine())
+        try:
+            # Check out a connection now so replica failures surface here
+            # rather than halfway through the endpoint.
+            db.connection(execution_options={"postgresql_readonly": True})
+            replica_health.replica_sessions += 1
+        except exc.DBAPIError as e:
+            print(f"Replica unavailable, falling back to primary: {e}")
+            db.close()
+            db = None
+            replica_health.mark_down(e)
+    if db is None:
+        if DATABASE_REPLICA_URL:
+            replica_health.fallbacks += 1
+        db = SessionLocal(bind=get_engine())
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# --- Async Engine (asyncpg) ---
+# Async endpoints use this engine so queries do not block the event loop.
+# ASYNC_DATABASE_URL may be set explicitly; otherwise DATABASE_URL is reused
+# with the asyncpg driver.
+# asyncpg prepares every statement server-side and keeps an LRU of them per
+# connection; size it to hold the whole hot-query catalog (queries.py).
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(
+    os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "256"))
+
+
+def to_async_url(url: str):
+    """Return (async_url, connect_args) for the asyncpg driver."""
+    parsed = make_url(url)
+    connect_args = {}
+    query = dict(parsed.query)
+    query.setdefault("prepared_statement_cache_size",
+                     str(DB_PREPARED_STATEMENT_CACHE_SIZE))
+    # asyncpg does not understand libpq's sslmode; pass it as ssl instead
+    sslmode = query.pop("sslmode", None)
+    if sslmode and sslmode != "disable":
+        connect_args["ssl"] = sslmode
+    parsed = parsed.set(drivername="postgresql+asyncpg", query=query)
+    return parsed.render_as_string(hide_password=False), connect_args
+
+
+class PreparedStatementStats:
+    """Counts prepared-statement creation vs reuse on the async engine.
+
+    Mirrors asyncpg's per-connection LRU: the first execution of a statement
+    on a connection prepares it, later executions reuse it.
+    """
+
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self.prepared = 0
+        self.reused = 0
+
+    def record(self, connection_info: dict, statement: str):
+        seen = connection_info.setdefault("prepared_statements", OrderedDict())
+        with self._lock:
+            if statement in seen:
+                seen.move_to_end(statement)
+                self.reused += 1
+                return
+            seen[statement] = True
+            self.prepared += 1
+            if len(seen) > self.cache_size:
+                seen.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            executions = self.prepared + self.reused
+            return {
+                "cache_size_per_connection": self.cache_size,
+                "prepared": self.prepared,
+                "reused": self.reused,
+                "reuse_ratio": round(self.reused / executions, 4) if executions else 0.0
+            }
+
+
+prepared_statement_stats = PreparedStatementStats(
+    DB_PREPARED_STATEMENT_CACHE_SIZE)
+
+
+def _count_prepared_statement(conn, cursor, statement, parameters, context, executemany):
+    prepared_statement_stats.record(conn.info, statement)
+
+
+def _build_async_engine():
+    async_url, connect_args = to_async_url(
+        os.getenv("ASYNC_DATABASE_URL") or require_database_url())
+    engine = create_async_engine(
+        async_url, connect_args=connect_args,
+        **pool_options(AsyncAdaptedQueuePool, async_engine_stats))
+    install_idle_preping(engine.sync_engine, async_engine_stats)
+    event.listen(engine.sync_engine, "before_cursor_execute",
+                 _count_prepared_statement)
+    return engine
+
+
+def get_async_engine():
+    """The asyncpg engine, built on first use."""
+    return _lazy_engine("async", _build_async_engine)
+
+
+AsyncSessionLocal = async_sessionmaker(
+    class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal(bind=get_async_engine()) as db:
+        yield db
+
+
+def __getattr__(name):
+    # Keep `from database import engine` working without building engines at import.
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    if name == "replica_engine":
+        return get_replica_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --- Startup Warm-up ---
+# Opening connections and preparing the hot statements before the worker is
+# marked ready means the first real requests after a deploy do not pay for
+# TCP/TLS/auth handshakes or cold query plans.
+DB_POOL_PREWARM = int(os.getenv("DB_POOL_PREWARM", "2"))
+
+
+def describe_database_url(url: str) -> str:
+    """Host/database part of a URL with credentials masked, for logs."""
+    return make_url(url).render_as_string(hide_password=True)
+
+
+def _prewarm_sync_engine(engine, connections: int):
+    opened = []
+    try:
+        for _ in range(connections):
+            conn = engine.connect()
+            opened.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in opened:
+            conn.close()
+
+
+async def _prewarm_async_engine(connections: int, statements):
+    engine = get_async_engine()
+
+    skipped = []
+
+    async def _open_and_prepare():
+        conn = await engine.connect()
+        # Executing the read statements once prepares them on this connection.
+        # One that references schema a pending migration adds is skipped.
+        async with conn.begin():
+            for stmt, params in statements:
+                try:
+                    async with conn.begin_nested():
+                        await conn.execute(stmt, params)
+                except exc.ProgrammingError as e:
+                    if stmt not in skipped:
+                        skipped.append(stmt)
+                        print(f"[DB] Warm-up statement skipped: {e.orig}")
+        return conn
+
+    opened = await asyncio.gather(*[_open_and_prepare() for _ in range(connections)],
+                                  return_exceptions=True)
+    errors = [c for c in opened if isinstance(c, BaseException)]
+    for conn in opened:
+        if not isinstance(conn, BaseException):
+            await conn.close()
+    if errors:
+        raise errors[0]
+    return skipped
+
+
+async def prewarm_pools(statements=(), connections: int = DB_POOL_PREWARM):
+    """Build the engines and open `connections` per pool.
+
+    Returns the timings in ms and the statements that failed to prepare.
+    """
+    timings = {}
+    connections = max(1, min(connections, DB_POOL_SIZE + DB_MAX_OVERFLOW))
+
+    started = time.perf_counter()
+    await asyncio.to_thread(_prewarm_sync_engine, get_engine(), connections)
+    timings["sync_pool_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    skipped = await _prewarm_async_engine(connections, statements)
+    timings["async_pool_and_statements_ms"] = round(
+        (time.perf_counter() - started) * 1000, 1)
+
+    if DATABASE_REPLICA_URL:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(_prewarm_sync_engine, get_replica_engine(), connections)
+        except exc.DBAPIError as e:
+            # A missing replica must not keep the worker out of rotation
+            replica_health.mark_down(e)
+        timings["replica_pool_ms"] = round(
+            (time.perf_counter() - started) * 1000, 1)
+    return timings, skipped
+
+
+async def dispose_engines():
+    """Close every engine that was built."""
+    for name, engine in list(_engines.items()):
+        if name == "async":
+            await engine.dispose()
+        else:
+            engine.dispose()
+    _engines.clear()
+
+
+def pool_statistics() -> dict:
+    stats = {"replica": replica_health.snapshot()}
+    if "sync" in _engines:
+        stats["sync"] = describe_pool(_engines["sync"], engine_stats)
+    if "async" in _engines:
+        stats["async"] = describe_pool(
+            _engines["async"].sync_engine, async_engine_stats)
+    if "replica" in _engines:
+        stats["replica"].update(describe_pool(
+            _engines["replica"], replica_engine_stats))
+    return stats
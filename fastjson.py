@@ -0,0 +1,46 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the stdlib encoder is the fallback
+    orjson = None
+
+# --- Fast JSON Responses ---
+# List endpoints return rows straight from the database, so there is nothing
+# for pydantic to validate. FastJSONResponse serializes them in one pass with
+# orjson (datetimes natively, Decimals through `_default`) and skips
+# FastAPI's jsonable_encoder walk and response-model validation entirely.
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    """Serialize to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(content, default=_default, separators=(",", ":"),
+                      ensure_ascii=False).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """JSON response for trusted, already-shaped data (rows, dicts, lists)."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def rows_to_dicts(columns, rows) -> list:
+    """Zip result rows with column names, leaving values for the encoder."""
+    return [dict(zip(columns, row)) for row in rows]
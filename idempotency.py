@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.responses import Response
+
+import queries
+from fastjson import dumps
+
+# --- Idempotency Key Settings ---
+# Purchase endpoints accept an Idempotency-Key header. The key is claimed in
+# the same transaction as the order and the response is stored before the
+# commit, so a retried request either replays the committed result or, if
+# the first attempt rolled back, runs again. Keys older than
+# IDEMPOTENCY_KEY_TTL_HOURS are purged by the background sweeper.
+IDEMPOTENCY_KEY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+REPLAY_HEADER = "Idempotent-Replayed"
+
+
+class IdempotentReplay(HTTPException):
+    """Raised to answer a repeated request with the stored response."""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(status_code=status_code)
+        self.body = body
+
+
+async def idempotent_replay_handler(request: Request, exc: IdempotentReplay) -> Response:
+    return Response(content=exc.body, status_code=exc.status_code,
+                    media_type="application/json", headers={REPLAY_HEADER: "true"})
+
+
+def fingerprint(endpoint: str, payload) -> str:
+    """SHA-256 of the endpoint and the canonical JSON of the request body."""
+    return hashlib.sha256(endpoint.encode() + b"\n" + dumps(payload)).hexdigest()
+
+
+class IdempotencyGuard:
+    """One Idempotency-Key for one user, endpoint and request body."""
+
+    def __init__(self, key: str, user_id: int, endpoint: str, payload):
+        if not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters.")
+        self.params = {'uid': user_id, 'key': key}
+        self.endpoint = endpoint
+        self.request_hash = fingerprint(endpoint, payload)
+
+    async def check(self, db):
+        """Replay a completed request before any product row is touched."""
+        row = (await db.execute(queries.IDEMPOTENCY_KEY_LOOKUP, self.params)).fetchone()
+        await db.rollback()
+        if row is not None:
+            self._replay(row)
+
+    async def claim(self, db):
+        """Insert the key inside the purchase transaction.
+
+        A concurrent request with the same key waits here until the first
+        one commits (and is then replayed) or rolls back (and proceeds).
+        """
+        claimed = (await db.execute(queries.CLAIM_IDEMPOTENCY_KEY, {
+            **self.params, 'endpoint': self.endpoint, 'hash': self.request_hash})).fetchone()
+        if claimed is None:
+            self._replay((await db.execute(
+                queries.IDEMPOTENCY_KEY_LOOKUP, self.params)).fetchone())
+
+    async def store(self, db, body, status_code: int = 200):
+        """Save the response in the same transaction, before the commit."""
+        await db.execute(queries.STORE_IDEMPOTENT_RESPONSE, {
+            **self.params, 'status': status_code, 'response': dumps(body).decode()})
+
+    def _replay(self, row):
+        if row is None:
+            # Purged between the conflicting insert and the lookup
+            raise HTTPException(
+                status_code=409, detail="A request with this Idempotency-Key is still in progress.")
+        endpoint, request_hash, status_code, body = row
+        if endpoint != self.endpoint or request_hash != self.request_hash:
+            raise HTTPException(
+                status_code=422, detail="Idempotency-Key was already used for a different request.")
+        if body is None:
+            raise HTTPException(
+                status_code=409, detail="A request with this Idempotency-Key is still in progress.")
+        raise IdempotentReplay(status_code, body)
+
+
+def idempotency_guard(key, user_id: int, endpoint: str, payload):
+    """IdempotencyGuard for a request that sent the header, else None."""
+    if key is None:
+        return None
+    return IdempotencyGuard(key, user_id, endpoint, payload)
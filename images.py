@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it only the original is kept
+    Image = None
+
+# --- Image Pipeline Settings ---
+# Uploads are copied to disk in chunks off the event loop and capped at
+# IMAGE_UPLOAD_MAX_BYTES (the request body is already refused above it by
+# main.UploadSizeLimit, before it is spooled). Resized JPEG and WebP variants are then produced
+# in the background so catalog views can load small images.
+IMAGE_UPLOAD_MAX_BYTES = int(
+    os.getenv("IMAGE_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+# Uploads in progress, inside the store so the final rename is atomic
+INCOMING_DIR = ".incoming"
+
+# Variant name -> longest edge in pixels
+IMAGE_VARIANTS = {"thumb": 320, "medium": 960}
+VARIANT_FORMATS = {"jpeg": "jpg", "webp": "webp"}
+
+
+class ImageTooLarge(Exception):
+    """Raised when an upload exceeds IMAGE_UPLOAD_MAX_BYTES."""
+
+
+def store_upload_sync(source, root: Path, extension: str, max_bytes: int):
+    """Write an upload into the content-addressed store.
+
+    The file is hashed while it is copied in chunks, then moved to
+    ``<root>/ab/cd/<sha256><extension>``. Identical uploads land on the same
+    path, so a second copy is discarded. Returns (relative path, created).
+    """
+    incoming = root / INCOMING_DIR
+    incoming.mkdir(parents=True, exist_ok=True)
+    partial = incoming / (uuid.uuid4().hex + extension)
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        with partial.open("wb") as buffer:
+            while chunk := source.read(UPLOAD_CHUNK_BYTES):
+                written += len(chunk)
+                if written > max_bytes:
+                    raise ImageTooLarge()
+                digest.update(chunk)
+                buffer.write(chunk)
+        name = digest.hexdigest()
+        relative = f"{name[:2]}/{name[2:4]}/{name}{extension}"
+        target = root / relative
+        if target.exists():
+            partial.unlink()
+            return relative, False
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(partial, target)
+        return relative, True
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+
+def variant_path(original: Path, variant: str, fmt: str) -> Path:
+    return original.with_name(f"{original.stem}_{variant}.{VARIANT_FORMATS[fmt]}")
+
+
+def variant_urls(image_url: str) -> dict:
+    """URLs of every variant of an uploaded image, by variant and format."""
+    original = Path(image_url)
+    return {
+        variant: {fmt: variant_path(original, variant, fmt).as_posix()
+                  for fmt in VARIANT_FORMATS}
+        for variant in IMAGE_VARIANTS
+    }
+
+
+def thumbnail_url(image_url):
+    """WebP thumbnail URL for a content-addressed upload, else None.
+
+    Derived from the name alone, without touching the disk, since it runs
+    for every listed row. The thumbnail may still be generating (or have
+    failed), so clients fall back to image_url when it answers 404.
+    """
+    if Image is None or not image_url or not image_url.startswith("/uploads/"):
+        return None
+    if not CONTENT_ADDRESSED_PATH.match(image_url[len("/uploads/"):]):
+        return None
+    return variant_path(Path(image_url), "thumb", "webp").as_posix()
+
+
+def make_variants_sync(original: Path):
+    """Write every size/format variant of an image. Runs in a pipeline worker."""
+    with Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        for variant, edge in IMAGE_VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+            for fmt in VARIANT_FORMATS:
+                target = variant_path(original, variant, fmt)
+                # Written under a temporary name so a half-written variant
+                # is never served
+                partial = target.with_name(target.name + ".part")
+                if fmt == "jpeg":
+                    resized.convert("RGB").save(
+                        partial, "JPEG", quality=82, optimize=True, progressive=True)
+                else:
+                    resized.save(partial, "WEBP", quality=80, method=4)
+                os.replace(partial, target)
+
+
+class ImagePipeline:
+    """Saves uploads off the event loop and builds variants in worker threads."""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._executor = None
+        # Completion callbacks run on worker threads
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="image-variants")
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def store(self, upload, root: Path, extension: str):
+        return await asyncio.to_thread(
+            store_upload_sync, upload, root, extension, IMAGE_UPLOAD_MAX_BYTES)
+
+    def submit(self, original: Path) -> bool:
+        """Queue variant generation. Returns False when Pillow is unavailable."""
+        if not self.enabled:
+            return False
+        if variant_path(original, "thumb", "webp").exists():
+            # Deduplicated upload whose variants were built before
+            return True
+        with self._lock:
+            self.pending += 1
+        future = self.start().submit(make_variants_sync, original)
+        future.add_done_callback(lambda f: self._done(original, f))
+        return True
+
+    def _done(self, original: Path, future):
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            self.pending -= 1
+            if future.cancelled():
+                return
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if error is not None:
+            print(f"Image variant error for {original.name}: {error}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "workers": self.workers,
+            "max_upload_bytes": IMAGE_UPLOAD_MAX_BYTES,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+
+image_pipeline = ImagePipeline(IMAGE_WORKERS)
+
+
+# --- Immutable Serving ---
+# Content-addressed names never change meaning, so they can be cached forever.
+CONTENT_ADDRESSED_PATH = re.compile(
+    r"^[0-9a-f]{2}/[0-9a-f]{2}/(?P<name>[0-9a-f]{64}(?:_[a-z]+)?)\.[a-z0-9]+$")
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles that marks content-addressed files immutable.
+
+    Such files get a strong ETag derived from their name and a one-year
+    immutable Cache-Control. Older flat uploads keep the default headers.
+    """
+
+    async def get_response(self, path: str, scope):
+        if any(part.startswith(".") for part in Path(path).parts):
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        match = CONTENT_ADDRESSED_PATH.match("/".join(Path(full_path).parts[-3:]))
+        if match:
+            response.headers["etag"] = f'"{match.group("name")}"'
+            response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -1,27 +1,51 @@
+import time
+# Taken first so /health/ready can report how long module imports took.
+_import_started = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import timedelta, datetime
+from decimal import Decimal
 from typing import Annotated, List, Optional
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Header, Query, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import Path
 from fastapi.staticfiles import StaticFiles
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
 from jose import jwt as jose_jwt, JWTError
 from jwt.exceptions import InvalidSignatureError
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+import csv
+import hashlib
+import io
+import json
 import random
-import bcrypt
 import os
-import shutil
+import threading
+from collections import OrderedDict
 from pathlib import Path as FilePath
 # NEW IMPORT: For CORS handling
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.exc import DBAPIError
-from psycopg2.errors import ForeignKeyViolation
+from fastapi.middleware.gzip import GZipMiddleware
+from sqlalchemy.exc import DBAPIError, ProgrammingError
+_third_party_imported = time.perf_counter()
 
 # Internal project imports
-from database import get_db
+import queries
+from database import (get_db, get_read_db, get_async_db, get_async_engine, AsyncSessionLocal,
+                      DATABASE_URL, describe_database_url, dispose_engines, prewarm_pools,
+                      pool_statistics, prepared_statement_stats)
+from passwords import password_hasher, PasswordHasherBusy
+from images import (image_pipeline, ImageTooLarge, ImmutableStaticFiles, IMAGE_UPLOAD_MAX_BYTES,
+                    thumbnail_url, variant_path, variant_urls)
+from static_assets import static_assets
+from fastjson import FastJSONResponse, dumps as fast_dumps, rows_to_dicts
+from idempotency import (IdempotencyGuard, IdempotentReplay, idempotency_guard,
+                         idempotent_replay_handler, IDEMPOTENCY_KEY_TTL_HOURS, REPLAY_HEADER)
+_project_imported = time.perf_counter()
 
 # --- CONFIGURATION AND SECURITY ---
 SECRET_KEY = "SUPER_SECURE_KEY_FOR_MARKETPLACE"
@@ -33,11 +57,15 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # Commission rate for the marketplace (15%)
 MARKETPLACE_COMMISSION_RATE = 0.15
 
+# Let Postgres build the JSON for the wallet, audit-log and sellers lists
+# (json_agg) instead of converting rows in Python. Set to 0 to disable.
+DB_JSON_AGGREGATION = os.getenv("DB_JSON_AGGREGATION", "1") == "1"
+
 
 # --- UTILITY FUNCTIONS ---
-def verify_password(plain_password, hashed_password):
-    """Checks if a plain password matches the hashed password using bcrypt directly."""
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def verify_password(plain_password, hashed_password):
+    """Checks if a plain password matches the hashed password in the bcrypt worker pool."""
+    return await password_hasher.verify(plain_password, hashed_password)
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -53,18 +81,34 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 class DBUser:
-    def __init__(self, user_id: int, email: str, password_hash: str):
+    def __init__(self, user_id: int, email: str, password_hash: str, role: str = None, token_version: int = 0):
         self.user_id = user_id
         self.email = email
         self.password_hash = password_hash
+        self.role = role
+        self.token_version = token_version
+
+
+# Cleared when "User".token_version is missing; tokens then carry no "ver"
+# claim and get_current_user checks them against the database.
+_token_version_column = True
 
 
-def authenticate_user(db: Session, email: str, password: str):
+async def authenticate_user(db: AsyncSession, email: str, password: str):
     """Retrieves user from DB and verifies the password hash."""
     print(f"[AUTH] Authenticating: {email}")
-    query = text(
-        'SELECT user_id, email, password_hash, COALESCE(is_active, TRUE) FROM "User" WHERE email = :email')
-    result = db.execute(query, {'email': email}).fetchone()
+    global _token_version_column
+    result = None
+    if _token_version_column:
+        try:
+            result = (await db.execute(queries.AUTHENTICATE_USER, {'email': email})).fetchone()
+        except ProgrammingError as e:
+            # add_token_version.sql not applied yet
+            await db.rollback()
+            print(f"[AUTH] Token versions unavailable, issuing unversioned tokens: {e.orig}")
+            _token_version_column = False
+    if not _token_version_column:
+        result = (await db.execute(queries.AUTHENTICATE_USER_UNVERSIONED, {'email': email})).fetchone()
     print(f"[AUTH] Query result: {result is not None}")
 
     if not result:
@@ -78,10 +122,11 @@ def authenticate_user(db: Session, email: str, password: str):
         print(f"[AUTH] User not active")
         return None
 
-    user = DBUser(user_id=result[0], email=result[1], password_hash=result[2])
+    user = DBUser(user_id=result[0], email=result[1], password_hash=result[2],
+                  role=resolve_role(result[1], result[4]), token_version=result[5])
 
     # Verify password
-    password_valid = verify_password(password, user.password_hash)
+    password_valid = await verify_password(password, user.password_hash)
     print(f"[AUTH] Password valid: {password_valid}")
     if not password_valid:
         print(f"[AUTH] Password verification failed")
@@ -91,7 +136,330 @@ def authenticate_user(db: Session, email: str, password: str):
     return user
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+# --- PRINCIPAL CACHE ---
+# Resolved principals are cached per user_id so dashboards calling several
+# endpoints per page load do not repeat the role lookup on every request.
+PRINCIPAL_CACHE_TTL_SECONDS = float(
+    os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "60"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(
+    os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+
+
+class PrincipalCache:
+    """Bounded TTL/LRU cache of resolved principals keyed by user_id."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, user_id: int, principal: dict):
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[user_id] = (expires_at, dict(principal))
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+principal_cache = PrincipalCache(
+    PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_ENTRIES)
+
+
+def resolve_role(email: str, role: str):
+    """Apply the admin rule on top of the Artisan/Customer role."""
+    # Check if admin (you can add admin table check or use a flag in User table)
+    # For now, if email contains "admin", treat as admin
+    if "admin" in email.lower():
+        return "admin"
+    return role
+
+
+async def load_principal(db: AsyncSession, user_id: int):
+    """Resolve an active user's id, email and role in a single query."""
+    row = (await db.execute(queries.PRINCIPAL_BY_ID, {'uid': user_id})).fetchone()
+    if row is None:
+        return None
+
+    return {"user_id": row[0], "email": row[1], "role": resolve_role(row[1], row[2])}
+
+
+# --- TOKEN VERSIONS ---
+# Access tokens carry the user's role and token_version, so the common case
+# is authorized from the claims alone. Suspending, rejecting or changing the
+# role of a user bumps "User".token_version (a deleted user gets a
+# RevokedUser row instead). Every worker keeps the minimum accepted version
+# per revoked user in memory and polls for bumps made by other workers.
+TOKEN_VERSION_POLL_SECONDS = float(
+    os.getenv("TOKEN_VERSION_POLL_SECONDS", "15"))
+TOKEN_VERSION_POLL_OVERLAP = timedelta(seconds=5)
+
+
+class TokenVersionRegistry:
+    """In-memory map of user_id -> minimum token version still accepted."""
+
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self._min_versions = {}
+        self._lock = threading.Lock()
+        self._since = datetime(1970, 1, 1)
+        self._next_poll = 0.0
+        # Stays False until the first successful load; until then every token
+        # is checked against the database.
+        self.loaded = False
+
+    def accepts(self, user_id: int, version: int) -> bool:
+        return version >= self._min_versions.get(user_id, 0)
+
+    def set_min_version(self, user_id: int, version):
+        if version is None:
+            return
+        with self._lock:
+            if version > self._min_versions.get(user_id, 0):
+                self._min_versions[user_id] = version
+        principal_cache.invalidate(user_id)
+
+    def revoke_all(self, user_id: int):
+        """Reject every token of a user that no longer exists."""
+        self.set_min_version(user_id, float("inf"))
+
+    async def refresh_if_due(self, db: AsyncSession):
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.poll_seconds
+        try:
+            rows = (await db.execute(queries.TOKEN_VERSION_CHANGES, {
+                    'since': self._since})).fetchall()
+        except DBAPIError as e:
+            await db.rollback()
+            print(f"[AUTH] Token version poll failed: {e}")
+            return
+        for user_id, version, updated_at in rows:
+            self.set_min_version(user_id, version)
+            # Re-read a small window on the next poll so bumps committed
+            # slightly out of timestamp order are not missed.
+            if updated_at - TOKEN_VERSION_POLL_OVERLAP > self._since:
+                self._since = updated_at - TOKEN_VERSION_POLL_OVERLAP
+        self.loaded = True
+
+
+token_versions = TokenVersionRegistry(TOKEN_VERSION_POLL_SECONDS)
+
+
+def bump_token_version(db: Session, user_id: int):
+    """Increment a user's token version inside the caller's transaction.
+
+    Call ``token_versions.set_min_version`` with the result after commit.
+    """
+    return db.execute(queries.BUMP_TOKEN_VERSION, {'uid': user_id}).scalar()
+
+
+# --- CATALOG CACHE ---
+# Serialized /products pages are cached in-process under the current catalog
+# version. Any write to Product bumps the version, which drops every page.
+# Other workers only see the bump through CATALOG_CACHE_TTL_SECONDS expiry,
+# so the ETag is a hash of the body: it stays correct across workers.
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "30"))
+CATALOG_CACHE_MAX_ENTRIES = int(os.getenv("CATALOG_CACHE_MAX_ENTRIES", "512"))
+
+
+class CatalogPage:
+    """One cached, already serialized catalog response."""
+
+    def __init__(self, version: int, body: bytes, next_cursor: Optional[str]):
+        self.version = version
+        self.body = body
+        self.next_cursor = next_cursor
+        # Weak: GZipMiddleware may serve the body compressed, and both
+        # encodings share this one tag
+        self.etag = 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.expires_at = time.monotonic() + CATALOG_CACHE_TTL_SECONDS
+
+
+class CatalogCache:
+    """Bounded LRU of catalog pages, invalidated wholesale by a version bump."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bumps = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            page = self._entries.get(key)
+            if page is None or page.version != self.version or page.expires_at <= now:
+                if page is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def put(self, key, page: CatalogPage):
+        if self.max_entries <= 0 or CATALOG_CACHE_TTL_SECONDS <= 0:
+            return
+        with self._lock:
+            # A bump while the page was being built makes it stale already
+            if page.version != self.version:
+                return
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def bump(self):
+        """Drop every cached page; see catalog_changed."""
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self.bumps += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "version": self.version,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": CATALOG_CACHE_TTL_SECONDS,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "bumps": self.bumps
+            }
+
+
+catalog_cache = CatalogCache(CATALOG_CACHE_MAX_ENTRIES)
+
+
+class FacetCache:
+    """Facet counts per filter combination, invalidated per artisan.
+
+    A product change only drops the entries it can affect: those filtered to
+    the same artisan and those not filtered by artisan at all.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, key, generation: int, facets: dict):
+        if self.max_entries <= 0 or CATALOG_CACHE_TTL_SECONDS <= 0:
+            return
+        with self._lock:
+            # Skip results computed across an invalidation
+            if generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + CATALOG_CACHE_TTL_SECONDS, facets)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, artisan_id: Optional[int]):
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries
+                        if artisan_id is None or dict(k).get("artisan_id") in (None, artisan_id)]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations
+            }
+
+
+facet_cache = FacetCache(CATALOG_CACHE_MAX_ENTRIES)
+
+
+def catalog_changed(artisan_id: Optional[int] = None):
+    """Call after committing any change to products or stock."""
+    catalog_cache.bump()
+    facet_cache.invalidate(artisan_id)
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
     """Decode JWT token and get current user with role information."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -107,30 +475,24 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
     except JWTError:
         raise credentials_exception
 
-    query = text(
-        'SELECT user_id, email FROM "User" WHERE user_id = :uid AND is_active = TRUE')
-    result = db.execute(query, {'uid': user_id}).fetchone()
-    if result is None:
-        raise credentials_exception
-
-    # Determine user role by checking which table they belong to
-    role = None
-    artisan_check = db.execute(text("SELECT artisan_id FROM Artisan WHERE artisan_id = :uid"), {
-                               'uid': user_id}).fetchone()
-    if artisan_check:
-        role = "artisan"
-    else:
-        customer_check = db.execute(text(
-            "SELECT customer_id FROM Customer WHERE customer_id = :uid"), {'uid': user_id}).fetchone()
-        if customer_check:
-            role = "buyer"
-
-    # Check if admin (you can add admin table check or use a flag in User table)
-    # For now, if email contains "admin", treat as admin
-    if "admin" in result[1].lower():
-        role = "admin"
+    # Fast path: authorize from the role/version claims.
+    token_version = payload.get("ver")
+    if "role" in payload and token_version is not None:
+        await token_versions.refresh_if_due(db)
+        if token_versions.loaded:
+            if not token_versions.accepts(user_id, token_version):
+                raise credentials_exception
+            return {"user_id": user_id, "email": email, "role": payload["role"]}
+
+    # Tokens without claims (or before versions are known) are checked in the DB.
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        principal = await load_principal(db, user_id)
+        if principal is None:
+            raise credentials_exception
+        principal_cache.put(user_id, principal)
 
-    return {"user_id": result[0], "email": result[1], "role": role}
+    return principal
 
 
 async def verify_role(current_user: dict, required_role: str):
@@ -142,21 +504,257 @@ async def verify_role(current_user: dict, required_role: str):
         )
 
 
+# --- STARTUP WARM-UP ---
+# The worker reports ready only after the pools hold open connections, the
+# hot statements are prepared, the token version map is loaded and the
+# password workers are spawned and the first catalog page and its facets are
+# cached. Failed attempts are retried in the background.
+# On a database missing later migrations the statements and token versions
+# that need them are skipped, and the worker is ready but listed as degraded:
+# logins then issue tokens without a version claim, which are checked against
+# the database on every request.
+STARTUP_RETRY_SECONDS = float(os.getenv("STARTUP_RETRY_SECONDS", "2"))
+
+startup_state = {
+    "ready": False,
+    "degraded": [],
+    "attempts": 0,
+    "last_error": None,
+    "timings_ms": {
+        "third_party_imports": round((_third_party_imported - _import_started) * 1000, 1),
+        "project_imports": round((_project_imported - _third_party_imported) * 1000, 1),
+    },
+}
+
+
+def _record_timing(name: str, started: float):
+    startup_state["timings_ms"][name] = round(
+        (time.perf_counter() - started) * 1000, 1)
+
+
+async def warm_catalog_caches() -> list:
+    """Fill the catalog and facet caches with the unfiltered first page.
+
+    That is what the buyer page requests first. Returns the parts that
+    could not be loaded.
+    """
+    failed = []
+    async with AsyncSessionLocal(bind=get_async_engine()) as db:
+        try:
+            await read_products(limit=PRODUCT_PAGE_DEFAULT, cursor=None, motif=None,
+                                min_price=None, max_price=None, artisan_id=None,
+                                in_stock=False, if_none_match=None, db=db)
+        except HTTPException:
+            failed.append("catalog_cache")
+        await db.rollback()
+        try:
+            await read_product_facets(motif=None, min_price=None, max_price=None,
+                                      artisan_id=None, in_stock=False, db=db)
+        except HTTPException:
+            failed.append("facet_cache")
+    return failed
+
+
+async def warm_up():
+    """Pre-warm pools, statements and caches; retry until it succeeds."""
+    started = time.perf_counter()
+    while True:
+        startup_state["attempts"] += 1
+        try:
+            timings, skipped = await prewarm_pools(queries.WARMUP)
+            startup_state["timings_ms"].update(timings)
+            names = {id(stmt): name for name, stmt in queries.CATALOG.items()}
+            degraded = [f"statement:{names.get(id(stmt), '?')}" for stmt in skipped]
+
+            step = time.perf_counter()
+            async with AsyncSessionLocal(bind=get_async_engine()) as db:
+                await token_versions.refresh_if_due(db)
+            if not token_versions.loaded:
+                degraded.append("token_versions")
+            _record_timing("token_versions", step)
+
+            step = time.perf_counter()
+            degraded.extend(await warm_catalog_caches())
+            _record_timing("catalog_cache", step)
+
+            step = time.perf_counter()
+            await password_hasher.warm()
+            _record_timing("password_workers", step)
+        except Exception as e:
+            startup_state["last_error"] = str(e)
+            print(f"[STARTUP] Warm-up attempt {startup_state['attempts']} failed: {e}")
+            # Make the next attempt poll token versions again straight away
+            token_versions._next_poll = 0.0
+            await asyncio.sleep(STARTUP_RETRY_SECONDS)
+            continue
+        _record_timing("warm_up", started)
+        startup_state["ready"] = True
+        startup_state["degraded"] = degraded
+        startup_state["last_error"] = None
+        if degraded:
+            print(f"[STARTUP] Ready, degraded (migrations pending?): {degraded}")
+        print(f"[STARTUP] Ready: {startup_state['timings_ms']}")
+        return
+
+
+# --- RESERVATION SWEEPER ---
+# Holds placed through /buyer/reservations expire after RESERVATION_TTL_SECONDS.
+# Every RESERVATION_SWEEP_SECONDS each worker returns expired holds to
+# available stock in batches of RESERVATION_SWEEP_BATCH. The same task purges
+# idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS.
+RESERVATION_TTL_SECONDS = float(os.getenv("RESERVATION_TTL_SECONDS", "600"))
+RESERVATION_SWEEP_SECONDS = float(os.getenv("RESERVATION_SWEEP_SECONDS", "10"))
+RESERVATION_SWEEP_BATCH = int(os.getenv("RESERVATION_SWEEP_BATCH", "1000"))
+
+
+class ReservationSweeper:
+    """Background task that releases expired holds and purges old idempotency keys."""
+
+    def __init__(self, interval: float, batch: int):
+        self.interval = interval
+        self.batch = batch
+        self.runs = 0
+        self.released = 0
+        self.keys_purged = 0
+        self.failures = 0
+        self.last_error = None
+
+    async def sweep(self) -> int:
+        """Release every expired hold, one batch per transaction."""
+        total = 0
+        async with AsyncSessionLocal(bind=get_async_engine()) as db:
+            while True:
+                count = (await db.execute(queries.SWEEP_EXPIRED_RESERVATIONS,
+                                          {'batch': self.batch})).scalar_one()
+                await db.commit()
+                total += count
+                if count < self.batch:
+                    break
+            while True:
+                purged = (await db.execute(queries.PURGE_IDEMPOTENCY_KEYS, {
+                    'ttl': IDEMPOTENCY_KEY_TTL_HOURS * 3600, 'batch': self.batch})).scalar_one()
+                await db.commit()
+                self.keys_purged += purged
+                if purged < self.batch:
+                    break
+        self.runs += 1
+        self.released += total
+        return total
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"[RESERVATIONS] Sweep failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "ttl_seconds": RESERVATION_TTL_SECONDS,
+            "interval_seconds": self.interval,
+            "batch": self.batch,
+            "runs": self.runs,
+            "released": self.released,
+            "idempotency_keys_purged": self.keys_purged,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
+
+
+reservation_sweeper = ReservationSweeper(RESERVATION_SWEEP_SECONDS, RESERVATION_SWEEP_BATCH)
+
+
 # --- FASTAPI APPLICATION ---
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start shared worker pools on startup and release them on shutdown."""
+    _record_timing("import_to_startup", _import_started)
+    if DATABASE_URL:
+        print(f"[STARTUP] Database: {describe_database_url(DATABASE_URL)}")
+    password_hasher.start()
+    image_pipeline.start()
+    static_assets.build()
+    warm_up_task = asyncio.create_task(warm_up())
+    sweeper_task = asyncio.create_task(reservation_sweeper.run())
+    yield
+    warm_up_task.cancel()
+    sweeper_task.cancel()
+    password_hasher.shutdown()
+    image_pipeline.shutdown()
+    await dispose_engines()
+
+
 app = FastAPI(
     title="Local Artisan Marketplace API",
     description="Backend for handling secure authentication and marketplace integrity.",
+    lifespan=lifespan,
 )
+# Repeated purchase requests are answered with their stored response
+app.add_exception_handler(IdempotentReplay, idempotent_replay_handler)
 
 # --- STATIC FILES MOUNTING ---
-# Mount the uploads directory to serve product images
-os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Mount the uploads directory to serve product images. Content-addressed
+# uploads are served with immutable caching headers.
+UPLOADS_DIR = FilePath("uploads")
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+app.mount("/uploads", ImmutableStaticFiles(directory=UPLOADS_DIR), name="uploads")
 # Mount the images directory to serve site assets (thumbnails, etc.)
 os.makedirs("images", exist_ok=True)
 app.mount("/images", StaticFiles(directory="images"), name="images")
 
+# --- UPLOAD SIZE LIMITS ---
+# FastAPI reads (and spools) a whole multipart body before the endpoint runs,
+# so an endpoint's own size check comes too late to protect memory or disk.
+# Routes register their cap in UPLOAD_BODY_LIMITS; bodies above it are
+# refused here, from Content-Length or while the body streams in. The
+# allowance covers the multipart boundaries and the other form fields.
+UPLOAD_BODY_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_BODY_LIMITS = {"/products/upload-image": IMAGE_UPLOAD_MAX_BYTES}
+
+
+def upload_too_large(cap: int) -> HTTPException:
+    return HTTPException(
+        status_code=413, detail=f"Upload too large. Maximum size is {cap // (1024 * 1024)} MB.")
+
+
+class UploadSizeLimit:
+    """ASGI middleware answering 413 for uploads above their route's cap."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        cap = UPLOAD_BODY_LIMITS.get(scope["path"]) if scope["type"] == "http" else None
+        if cap is None:
+            return await self.app(scope, receive, send)
+        limit = cap + UPLOAD_BODY_OVERHEAD_BYTES
+        length = Request(scope).headers.get("content-length", "")
+        if length.isdigit() and int(length) > limit:
+            error = upload_too_large(cap)
+            response = JSONResponse(status_code=error.status_code, content={"detail": error.detail})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            # Chunked uploads have no Content-Length; count what arrives
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise upload_too_large(cap)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# Added before CORS so that its 413 responses still carry the CORS headers
+app.add_middleware(UploadSizeLimit)
+
 # --- CORS MIDDLEWARE SETUP ---
 app.add_middleware(
     CORSMiddleware,
@@ -171,35 +769,68 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Pagination cursor must be readable by the frontends
+    expose_headers=["X-Next-Cursor", REPLAY_HEADER],
 )
 
+# --- RESPONSE COMPRESSION ---
+# JSON and other text responses above the threshold are gzipped. Responses
+# that already carry a Content-Encoding (the precompressed pages) and image
+# types are passed through untouched.
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_LEVEL)
+
+
+# --- HEALTH CHECKS ---
+
+@app.get("/health/live", tags=["Health"])
+async def health_live():
+    """The process is up and serving requests."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", tags=["Health"])
+async def health_ready():
+    """200 once the worker is warm, 503 until then. Used by the load balancer."""
+    body = {"status": ("degraded" if startup_state["degraded"] else "ready")
+            if startup_state["ready"] else "warming", **startup_state}
+    if not startup_state["ready"]:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=body)
+    return body
+
 
 # --- STATIC FILE SERVING ---
 
 @app.get("/", tags=["Static"])
-async def serve_login():
+async def serve_login(request: Request):
     """Serve the login page."""
-    return FileResponse("login.html")
+    return static_assets.response("login.html", request)
 
 
 @app.get("/login.html", tags=["Static"])
-async def serve_login_page():
-    return FileResponse("login.html")
+async def serve_login_page(request: Request):
+    return static_assets.response("login.html", request)
 
 
 @app.get("/buyer.html", tags=["Static"])
-async def serve_buyer_page():
-    return FileResponse("buyer.html")
+async def serve_buyer_page(request: Request):
+    return static_assets.response("buyer.html", request)
 
 
 @app.get("/artisan.html", tags=["Static"])
-async def serve_artisan_page():
-    return FileResponse("artisan.html")
+async def serve_artisan_page(request: Request):
+    return static_assets.response("artisan.html", request)
 
 
 @app.get("/admin.html", tags=["Static"])
-async def serve_admin_page():
-    return FileResponse("admin.html")
+async def serve_admin_page(request: Request):
+    return static_assets.response("admin.html", request)
+
+
+@app.get("/lang_translations.js", tags=["Static"])
+async def serve_translations(request: Request):
+    return static_assets.response("lang_translations.js", request)
 
 
 # --- DATABASE INITIALIZATION ENDPOINT ---
@@ -250,7 +881,13 @@ async def initialize_database(db: Session = Depends(get_db)):
             "add_orderitem_and_shipment.sql",
             "add_product_images.sql",
             "add_product_description.sql",
-            "add_complaint.sql"
+            "add_complaint.sql",
+            "add_token_version.sql",
+            "add_product_indexes.sql",
+            "add_product_search.sql",
+            "add_stock_reservations.sql",
+            "add_stock_shards.sql",
+            "add_idempotency_keys.sql"
         ]
 
         for migration in migration_files:
@@ -314,10 +951,16 @@ async def initialize_database(db: Session = Depends(get_db)):
 @app.post("/token", tags=["Authentication"])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        user = authenticate_user(db, form_data.username, form_data.password)
+        user = await authenticate_user(db, form_data.username, form_data.password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress. Please try again shortly.",
+            headers={"Retry-After": "1"},
+        )
     except Exception as e:
         print(f"\nERROR in authenticate_user: {type(e).__name__}: {e}")
         import traceback
@@ -329,8 +972,8 @@ async def login_for_access_token(
 
     if not user:
         # Check if user exists but is inactive
-        check_user = db.execute(text('SELECT user_id, is_active FROM "User" WHERE email = :email'),
-                                {"email": form_data.username}).fetchone()
+        check_user = (await db.execute(queries.USER_STATUS_BY_EMAIL,
+                                       {"email": form_data.username})).fetchone()
         if check_user and not check_user[1]:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -345,7 +988,8 @@ async def login_for_access_token(
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email, "user_id": user.user_id},
+        data={"sub": user.email, "user_id": user.user_id,
+              "role": user.role, "ver": user.token_version},
         expires_delta=access_token_expires
     )
 
@@ -389,8 +1033,7 @@ async def register_user(
 
     try:
         # Hash password
-        password_hash = bcrypt.hashpw(registration.password.encode(
-            'utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = await password_hasher.hash(registration.password)
 
         # Create User record (set is_active=FALSE for pending verification)
         user_query = text('''
@@ -420,6 +1063,12 @@ async def register_user(
             "email": registration.email
         }
 
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Registration is busy. Please try again shortly.",
+            headers={"Retry-After": "1"},
+        )
     except DBAPIError as e:
         db.rollback()
         print(f"Registration error: {e}")
@@ -447,6 +1096,7 @@ async def admin_activate_user(
         db.execute(text('UPDATE "User" SET is_active = TRUE WHERE user_id = :uid'), {
                    "uid": user_id})
         db.commit()
+        principal_cache.invalidate(user_id)
         return {"status": "ok", "message": "User activated", "user_id": user_id}
     except DBAPIError:
         db.rollback()
@@ -454,6 +1104,65 @@ async def admin_activate_user(
             status_code=500, detail="Database error while activating user")
 
 
+@app.get("/admin/auth-cache/stats", tags=["Admin"])
+async def get_auth_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Report principal cache size and hit/miss counters. Admin-only."""
+    await verify_role(current_user, "admin")
+    return principal_cache.stats()
+
+
+@app.get("/admin/catalog-cache/stats", tags=["Admin"])
+async def get_catalog_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Report catalog cache version, size and hit/miss counters. Admin-only."""
+    await verify_role(current_user, "admin")
+    return catalog_cache.stats()
+
+
+@app.get("/admin/facet-cache/stats", tags=["Admin"])
+async def get_facet_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Report facet cache size and hit/miss counters. Admin-only."""
+    await verify_role(current_user, "admin")
+    return facet_cache.stats()
+
+
+@app.get("/admin/image-pipeline/stats", tags=["Admin"])
+async def get_image_pipeline_stats(current_user: dict = Depends(get_current_user)):
+    """Report image variant queue and failures. Admin-only."""
+    await verify_role(current_user, "admin")
+    return image_pipeline.stats()
+
+
+@app.get("/admin/password-hasher/stats", tags=["Admin"])
+async def get_password_hasher_stats(current_user: dict = Depends(get_current_user)):
+    """Report bcrypt worker pool load and rejections. Admin-only."""
+    await verify_role(current_user, "admin")
+    return password_hasher.stats()
+
+
+@app.get("/admin/reservations/stats", tags=["Admin"])
+async def get_reservation_stats(current_user: dict = Depends(get_current_user)):
+    """Report reservation sweeper runs and released holds. Admin-only."""
+    await verify_role(current_user, "admin")
+    return reservation_sweeper.stats()
+
+
+@app.get("/admin/db/pool-stats", tags=["Admin"])
+async def get_db_pool_stats(current_user: dict = Depends(get_current_user)):
+    """Report connection pool occupancy, overflow, timeouts and checkout latency. Admin-only."""
+    await verify_role(current_user, "admin")
+    return pool_statistics()
+
+
+@app.get("/admin/db/prepared-statements", tags=["Admin"])
+async def get_prepared_statement_stats(current_user: dict = Depends(get_current_user)):
+    """Report how often server-side prepared statements were reused. Admin-only."""
+    await verify_role(current_user, "admin")
+    return {
+        "catalog_size": len(queries.CATALOG),
+        **prepared_statement_stats.snapshot()
+    }
+
+
 # --- PRODUCT DISPLAY MODEL ---
 class ProductDisplay(BaseModel):
     product_id: int
@@ -464,6 +1173,7 @@ class ProductDisplay(BaseModel):
     artisan_id: int
     seller_email: Optional[str] = None
     image_url: Optional[str] = None
+    thumbnail_url: Optional[str] = None
     description: Optional[str] = None
 
 
@@ -528,6 +1238,7 @@ async def create_product(
         }).scalar_one()
 
         db.commit()
+        catalog_changed(aid)
         return ProductDisplay(
             product_id=new_id,
             name=product.name,
@@ -550,11 +1261,142 @@ async def create_product(
         print(f"create_product took {int((time.time()-start_ts)*1000)}ms")
 
 
+# --- BULK PRODUCT IMPORT ---
+BULK_IMPORT_MAX_ROWS = int(os.getenv("BULK_IMPORT_MAX_ROWS", "50000"))
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_BODY_LIMITS["/products/bulk"] = BULK_IMPORT_MAX_BYTES
+BULK_IMPORT_CHUNK_ROWS = 5000
+PRODUCT_MAX_PRICE = Decimal("99999999.99")  # DECIMAL(10, 2)
+PRODUCT_MAX_STOCK = 2**31 - 1
+PRODUCT_MAX_IMAGE_URL = 500  # VARCHAR(500)
+
+
+def parse_bulk_rows(raw: bytes, filename: str, content_type: Optional[str]):
+    """Yield (row_number, row) from a CSV or NDJSON upload.
+
+    CSV rows come back as dicts; NDJSON rows as the raw line, decoded by the
+    caller so a malformed line is reported as a row error.
+    """
+    text_body = raw.decode("utf-8-sig")
+    is_csv = filename.lower().endswith(".csv") or (content_type or "").startswith("text/csv")
+    if is_csv:
+        for number, row in enumerate(csv.DictReader(io.StringIO(text_body)), start=1):
+            yield number, {key: (value if value != "" else None) for key, value in row.items() if key}
+        return
+    for number, line in enumerate(text_body.splitlines(), start=1):
+        if line.strip():
+            yield number, line
+
+
+def validate_bulk_rows(raw: bytes, filename: str, content_type: Optional[str]):
+    """Return (valid ProductCreate rows, per-row errors, total row count)."""
+    valid, errors, total = [], [], 0
+    try:
+        for number, row in parse_bulk_rows(raw, filename, content_type):
+            total += 1
+            if total > BULK_IMPORT_MAX_ROWS:
+                raise ValueError(f"Too many rows (max {BULK_IMPORT_MAX_ROWS}).")
+            try:
+                if isinstance(row, str):
+                    row = json.loads(row)
+                product = ProductCreate.model_validate(row)
+            except json.JSONDecodeError as e:
+                errors.append({"row": number, "error": f"invalid JSON: {e.msg}"})
+                continue
+            except ValidationError as e:
+                errors.append({"row": number, "error": "; ".join(
+                    ".".join(str(p) for p in err["loc"]) + ": " + err["msg"] if err["loc"] else err["msg"]
+                    for err in e.errors())})
+                continue
+            problem = None
+            if not product.name.strip() or len(product.name) > 255:
+                problem = "name must be 1-255 characters"
+            elif not 0 < round(product.price, 2) <= PRODUCT_MAX_PRICE:
+                # Stored as DECIMAL(10, 2), so judged after rounding to cents
+                problem = f"price must be at least 0.01 and at most {PRODUCT_MAX_PRICE}"
+            elif not 0 <= product.stock_quantity <= PRODUCT_MAX_STOCK:
+                problem = f"stock_quantity must be between 0 and {PRODUCT_MAX_STOCK}"
+            elif len(product.cultural_motif) > 100:
+                problem = "cultural_motif must be at most 100 characters"
+            elif product.image_url and len(product.image_url) > PRODUCT_MAX_IMAGE_URL:
+                problem = f"image_url must be at most {PRODUCT_MAX_IMAGE_URL} characters"
+            if problem:
+                errors.append({"row": number, "error": problem})
+            else:
+                valid.append(product)
+    except (UnicodeDecodeError, csv.Error, ValueError) as e:
+        # Malformed file (not a single bad row): the whole upload is rejected
+        raise HTTPException(status_code=400, detail=f"Could not read file: {e}")
+    return valid, errors, total
+
+
+@app.post("/products/bulk", tags=["Product Catalog"])
+async def bulk_import_products(
+    file: UploadFile = File(..., description="CSV with a header row, or NDJSON (.ndjson/.jsonl)"),
+    allow_partial: bool = Form(False),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Create many listings from one upload in a single transaction.
+
+    Rows use the same fields as POST /products. Invalid rows are reported by
+    row number; unless allow_partial is set, any invalid row aborts the import.
+    """
+    await verify_role(current_user, "artisan")
+    aid = current_user['user_id']
+    started = time.perf_counter()
+
+    # UploadSizeLimit has refused bodies far above the cap; this is the exact
+    # check on the file itself, reading at most one byte past it
+    raw = await file.read(BULK_IMPORT_MAX_BYTES + 1)
+    if len(raw) > BULK_IMPORT_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Import file too large. Maximum size is {BULK_IMPORT_MAX_BYTES // (1024 * 1024)} MB.")
+    valid, errors, total = await asyncio.to_thread(
+        validate_bulk_rows, raw, file.filename or "", file.content_type)
+
+    report = {"rows": total, "inserted": 0, "product_ids": [], "errors": errors}
+    if errors and not allow_partial:
+        raise HTTPException(status_code=422, detail={
+            "message": "Import rejected; fix the listed rows or set allow_partial.", **report})
+
+    if valid:
+        if not (await db.execute(queries.ARTISAN_EXISTS, {'uid': aid})).first():
+            raise HTTPException(
+                status_code=400, detail="Artisan profile not found for user.")
+        try:
+            for start in range(0, len(valid), BULK_IMPORT_CHUNK_ROWS):
+                chunk = valid[start:start + BULK_IMPORT_CHUNK_ROWS]
+                ids = (await db.execute(queries.BULK_INSERT_PRODUCTS, {
+                    'aid': aid,
+                    'names': [p.name for p in chunk],
+                    'prices': [p.price for p in chunk],
+                    'stocks': [p.stock_quantity for p in chunk],
+                    'motifs': [p.cultural_motif for p in chunk],
+                    'images': [p.image_url for p in chunk],
+                    'descs': [p.description for p in chunk]
+                })).scalars().all()
+                report["product_ids"].extend(ids)
+            await db.commit()
+        except DBAPIError as db_error:
+            await db.rollback()
+            print(f"--- BULK PRODUCT IMPORT FAIL ---: {db_error}")
+            raise HTTPException(
+                status_code=500, detail="Bulk import failed due to DB error; nothing was imported.")
+        catalog_changed(aid)
+
+    elapsed = time.perf_counter() - started
+    report["inserted"] = len(report["product_ids"])
+    report["elapsed_ms"] = round(elapsed * 1000, 1)
+    report["rows_per_second"] = round(report["inserted"] / elapsed, 1) if elapsed > 0 else None
+    return report
+
+
 @app.post("/products/upload-image", tags=["Product Catalog"])
 async def upload_product_image(
     file: UploadFile = File(...),
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: dict = Depends(get_current_user)
 ):
     """Upload a product image. Returns the image URL to be used when creating/updating products."""
     await verify_role(current_user, "artisan")
@@ -569,24 +1411,29 @@ async def upload_product_image(
             detail=f"Invalid file type. Allowed: {', '.join(allowed_extensions)}"
         )
 
-    # Generate unique filename
-    timestamp = int(datetime.now().timestamp())
-    unique_filename = f"product_{current_user['user_id']}_{timestamp}{file_extension}"
-    file_path = FilePath("uploads") / unique_filename
-
+    # Store by content hash; identical photos are kept once
+    extension = ".jpg" if file_extension == ".jpeg" else file_extension
     try:
-        # Save file
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # Return the URL path
-        image_url = f"/uploads/{unique_filename}"
-        return {"image_url": image_url, "filename": unique_filename}
-
+        stored_name, _ = await image_pipeline.store(file.file, UPLOADS_DIR, extension)
+    except ImageTooLarge:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large. Maximum size is {IMAGE_UPLOAD_MAX_BYTES // (1024 * 1024)} MB.")
     except Exception as e:
         print(f"Image upload error: {e}")
         raise HTTPException(status_code=500, detail="Failed to upload image")
 
+    # Return the URL path; resized variants appear at their URLs once built
+    image_url = f"/uploads/{stored_name}"
+    variants_enabled = image_pipeline.submit(UPLOADS_DIR / stored_name)
+    return {
+        "image_url": image_url,
+        "filename": stored_name,
+        "variants": variant_urls(image_url) if variants_enabled else {},
+        "variants_pending": variants_enabled and not variant_path(
+            UPLOADS_DIR / stored_name, "thumb", "webp").exists()
+    }
+
 
 @app.put("/products/{product_id}", tags=["Product Catalog"])
 async def update_product(
@@ -598,9 +1445,21 @@ async def update_product(
     """Update a product. Only the owning artisan can edit."""
     await verify_role(current_user, "artisan")
 
+    stock = updates.get('stock_quantity')
+    if 'stock_quantity' in updates and not (
+            type(stock) is int and 0 <= stock <= PRODUCT_MAX_STOCK):
+        raise HTTPException(
+            status_code=400, detail=f"stock_quantity must be an integer between 0 and {PRODUCT_MAX_STOCK}")
+
     # Ensure product belongs to current artisan
-    owner = db.execute(text("SELECT artisan_id FROM Product WHERE product_id = :pid"), {
-                       'pid': product_id}).fetchone()
+    try:
+        owner = db.execute(text("SELECT artisan_id, stock_shards FROM Product WHERE product_id = :pid"), {
+                           'pid': product_id}).fetchone()
+    except ProgrammingError:
+        # add_stock_shards.sql not applied: nothing can be sharded
+        db.rollback()
+        owner = db.execute(text("SELECT artisan_id, 0 FROM Product WHERE product_id = :pid"), {
+                           'pid': product_id}).fetchone()
     if not owner:
         raise HTTPException(status_code=404, detail="Product not found")
     if owner[0] != current_user['user_id']:
@@ -615,20 +1474,220 @@ async def update_product(
             fields.append(f"{key} = :{key}")
             params[key] = updates[key]
 
-    if not fields:
+    # New stock for a sharded product is spread over its slots instead
+    reshard = owner[1] > 0 and 'stock_quantity' in updates
+    if reshard:
+        fields.remove("stock_quantity = :stock_quantity")
+        params.pop('stock_quantity')
+
+    if not fields and not reshard:
         return {"status": "noop"}
 
     try:
-        q = text(
-            f"UPDATE Product SET {', '.join(fields)} WHERE product_id = :pid")
-        db.execute(q, params)
+        if fields:
+            q = text(
+                f"UPDATE Product SET {', '.join(fields)} WHERE product_id = :pid")
+            db.execute(q, params)
+        if reshard and db.execute(queries.RESHARD_STOCK, {
+                'pid': product_id, 'shards': owner[1], 'stock': stock}).fetchone() is None:
+            db.rollback()
+            raise HTTPException(
+                status_code=409, detail="Product has live reservations; try again once they are released.")
         db.commit()
+        catalog_changed(current_user['user_id'])
         return {"status": "ok"}
     except DBAPIError:
         db.rollback()
         raise HTTPException(status_code=500, detail="Update failed")
 
 
+# --- SHARDED STOCK ---
+# Opt-in per product for flash sales: stock is split across N slot rows so
+# concurrent purchases rarely touch the same row (see add_stock_shards.sql).
+PRODUCT_STOCK_MAX_SHARDS = 64
+
+
+class StockShardsUpdate(BaseModel):
+    shards: int
+    # New total stock; the current total is kept when omitted
+    stock_quantity: Optional[int] = None
+
+
+@app.put("/products/{product_id}/stock-shards", tags=["Product Catalog"])
+async def set_stock_shards(
+    product_id: int,
+    update: StockShardsUpdate,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Split a product's stock over `shards` slots, or merge it back with 0."""
+    await verify_role(current_user, "artisan")
+    if not 0 <= update.shards <= PRODUCT_STOCK_MAX_SHARDS:
+        raise HTTPException(
+            status_code=400, detail=f"shards must be between 0 and {PRODUCT_STOCK_MAX_SHARDS}.")
+    if update.stock_quantity is not None and not 0 <= update.stock_quantity <= PRODUCT_MAX_STOCK:
+        raise HTTPException(status_code=400, detail="stock_quantity must not be negative")
+
+    owner = (await db.execute(queries.PRODUCT_OWNERS, {'ids': [product_id]})).fetchone()
+    if not owner:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if owner[1] != current_user['user_id']:
+        raise HTTPException(
+            status_code=403, detail="Not authorized to edit this product")
+
+    try:
+        stock = (await db.execute(queries.RESHARD_STOCK, {
+            'pid': product_id, 'shards': update.shards,
+            'stock': update.stock_quantity})).scalar_one_or_none()
+        if stock is None:
+            await db.rollback()
+            raise HTTPException(
+                status_code=409, detail="Product has live reservations; try again once they are released.")
+        await db.commit()
+    except DBAPIError as db_error:
+        await db.rollback()
+        print(f"--- STOCK RESHARD FAIL ---: {db_error}")
+        raise HTTPException(status_code=500, detail="Stock update failed")
+    catalog_changed(owner[1])
+    return {"product_id": product_id, "stock_shards": update.shards, "stock_quantity": stock}
+
+
+# --- BATCH PRODUCT UPDATE ---
+PRODUCT_BATCH_MAX = 1000
+
+
+class ProductChange(BaseModel):
+    product_id: int
+    name: Optional[str] = None
+    price: Optional[float] = None
+    stock_quantity: Optional[int] = None
+    # Added to the (possibly new) stock_quantity; negative to remove stock
+    stock_delta: Optional[int] = None
+    cultural_motif: Optional[str] = None
+    image_url: Optional[str] = None
+    description: Optional[str] = None
+
+
+class ProductBatchUpdate(BaseModel):
+    changes: List[ProductChange]
+    allow_partial: bool = False
+
+
+def product_change_problem(change: ProductChange) -> Optional[str]:
+    """Column-level check for one batch change; None when it is acceptable."""
+    if change.name is not None and not 0 < len(change.name.strip()) <= 255:
+        return "name must be 1-255 characters"
+    if change.price is not None and not 0 < round(change.price, 2) <= PRODUCT_MAX_PRICE:
+        return f"price must be at least 0.01 and at most {PRODUCT_MAX_PRICE}"
+    if change.stock_quantity is not None and not 0 <= change.stock_quantity <= PRODUCT_MAX_STOCK:
+        return f"stock_quantity must be between 0 and {PRODUCT_MAX_STOCK}"
+    if change.stock_delta is not None and abs(change.stock_delta) > PRODUCT_MAX_STOCK:
+        return f"stock_delta must be between -{PRODUCT_MAX_STOCK} and {PRODUCT_MAX_STOCK}"
+    if change.cultural_motif is not None and len(change.cultural_motif) > 100:
+        return "cultural_motif must be at most 100 characters"
+    if change.image_url is not None and len(change.image_url) > PRODUCT_MAX_IMAGE_URL:
+        return f"image_url must be at most {PRODUCT_MAX_IMAGE_URL} characters"
+    return None
+
+
+def dropped_change_problem(change: ProductChange) -> str:
+    """Why BATCH_UPDATE_PRODUCTS skipped a change that passed the checks above.
+
+    The ownership and shard checks ran before the UPDATE, so a skipped row
+    without a stock change was deleted, reassigned or resharded meanwhile.
+    """
+    if change.stock_quantity is None and change.stock_delta is None:
+        return "not updated: the product was deleted or changed concurrently"
+    return (f"not updated: stock_quantity would leave 0-{PRODUCT_MAX_STOCK}, "
+            "or the product was changed concurrently")
+
+
+@app.patch("/products", tags=["Product Catalog"])
+async def batch_update_products(
+    batch: ProductBatchUpdate,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Edit or restock many of the artisan's products in one statement.
+
+    Ownership of every listed product is checked with a single query and all
+    changes are applied by one set-based UPDATE. By default the batch is
+    all-or-nothing; with allow_partial the valid changes are kept.
+    """
+    await verify_role(current_user, "artisan")
+    aid = current_user['user_id']
+    if not batch.changes:
+        return {"updated": [], "errors": []}
+    if len(batch.changes) > PRODUCT_BATCH_MAX:
+        raise HTTPException(
+            status_code=400, detail=f"At most {PRODUCT_BATCH_MAX} changes per batch.")
+
+    errors = {}
+    seen = set()
+    for change in batch.changes:
+        if change.product_id in seen:
+            errors[change.product_id] = "listed more than once"
+        seen.add(change.product_id)
+        problem = product_change_problem(change)
+        if problem:
+            errors.setdefault(change.product_id, problem)
+
+    owners = {row[0]: row[1:] for row in (await db.execute(
+        queries.PRODUCT_OWNERS, {'ids': list(seen)})).fetchall()}
+    for product_id in seen:
+        if product_id not in owners:
+            errors.setdefault(product_id, "Product not found")
+        elif owners[product_id][0] != aid:
+            errors.setdefault(product_id, "Not authorized to edit this product")
+    for change in batch.changes:
+        if (change.product_id in owners and owners[change.product_id][1] > 0
+                and (change.stock_quantity is not None or change.stock_delta is not None)):
+            errors.setdefault(
+                change.product_id, "stock is sharded; set it with PUT /products/{id}/stock-shards")
+
+    def rejected():
+        return HTTPException(status_code=422, detail={
+            "message": "Batch rejected; nothing was changed.",
+            "errors": [{"product_id": pid, "error": err} for pid, err in errors.items()]})
+
+    if errors and not batch.allow_partial:
+        raise rejected()
+
+    changes = [c for c in batch.changes if c.product_id not in errors]
+    updated = {}
+    if changes:
+        try:
+            updated = dict((await db.execute(queries.BATCH_UPDATE_PRODUCTS, {
+                'aid': aid,
+                'ids': [c.product_id for c in changes],
+                'names': [c.name for c in changes],
+                'prices': [c.price for c in changes],
+                'stocks': [c.stock_quantity for c in changes],
+                'deltas': [c.stock_delta for c in changes],
+                'motifs': [c.cultural_motif for c in changes],
+                'images': [c.image_url for c in changes],
+                'descs': [c.description for c in changes]
+            })).fetchall())
+            for c in changes:
+                if c.product_id not in updated:
+                    errors[c.product_id] = dropped_change_problem(c)
+            if errors and not batch.allow_partial:
+                await db.rollback()
+                raise rejected()
+            await db.commit()
+        except DBAPIError as db_error:
+            await db.rollback()
+            print(f"--- BATCH PRODUCT UPDATE FAIL ---: {db_error}")
+            raise HTTPException(status_code=500, detail="Batch update failed")
+        if updated:
+            catalog_changed(aid)
+
+    return {
+        "updated": [{"product_id": pid, "stock_quantity": stock} for pid, stock in updated.items()],
+        "errors": [{"product_id": pid, "error": err} for pid, err in errors.items()]
+    }
+
+
 @app.delete("/products/{product_id}", tags=["Product Catalog"])
 async def delete_product(
     product_id: int,
@@ -650,25 +1709,28 @@ async def delete_product(
         db.execute(text("DELETE FROM Product WHERE product_id = :pid"), {
                    'pid': product_id})
         db.commit()
+        catalog_changed(current_user['user_id'])
         return {"status": "ok"}
     except DBAPIError:
         db.rollback()
         raise HTTPException(status_code=500, detail="Delete failed")
 
 
-@app.get("/artisan/orders", tags=["Artisan"])
+ARTISAN_ORDER_COLUMNS = ("order_id", "order_date", "status", "product_name", "quantity",
+                         "amount", "courier_service", "shipped_date", "tracking_number")
+
+
+@app.get("/artisan/orders", tags=["Artisan"], response_class=FastJSONResponse)
 async def get_artisan_orders(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Return orders related to the current artisan's products."""
     await verify_role(current_user, "artisan")
 
     # Get artisan_id
-    artisan_query = text(
-        "SELECT artisan_id FROM Artisan WHERE artisan_id = :uid")
-    artisan = db.execute(
-        artisan_query, {'uid': current_user['user_id']}).fetchone()
+    artisan = (await db.execute(
+        queries.ARTISAN_EXISTS, {'uid': current_user['user_id']})).fetchone()
 
     if not artisan:
         return []
@@ -676,42 +1738,8 @@ async def get_artisan_orders(
     aid = artisan[0]
 
     # Get orders for this artisan's products with shipment info
-    query = text(
-        """
-        SELECT 
-            o.order_id, 
-            o.order_date, 
-            o.status, 
-            p.name,
-            oi.quantity,
-            COALESCE(t.amount,0) as amount,
-            s.courier_service,
-            s.shipped_date,
-            s.tracking_number
-        FROM Product p
-        JOIN OrderItem oi ON p.product_id = oi.product_id
-        JOIN "Order" o ON oi.order_id = o.order_id
-        LEFT JOIN "Transaction" t ON o.order_id = t.order_id
-        LEFT JOIN Shipment s ON o.order_id = s.order_id
-        WHERE p.artisan_id = :aid
-        ORDER BY o.order_date DESC
-        LIMIT 50
-        """
-    )
-    rows = db.execute(query, {"aid": aid}).fetchall()
-    return [
-        {
-            "order_id": r[0],
-            "order_date": r[1].isoformat(),
-            "status": r[2],
-            "product_name": r[3],
-            "quantity": r[4],
-            "amount": float(r[5]) if r[5] else 0.0,
-            "courier_service": r[6],
-            "shipped_date": r[7].isoformat() if r[7] else None,
-            "tracking_number": r[8]
-        } for r in rows
-    ]
+    rows = (await db.execute(queries.ARTISAN_ORDERS, {"aid": aid})).fetchall()
+    return FastJSONResponse(rows_to_dicts(ARTISAN_ORDER_COLUMNS, rows))
 
 
 @app.post("/artisan/payout-request", tags=["Artisan"])
@@ -828,7 +1856,10 @@ async def promote_to_artisan(
     try:
         db.execute(text('INSERT INTO Artisan(artisan_id) VALUES(:uid)'), {
                    "uid": user_id})
+        # Existing tokens carry the old role
+        version = bump_token_version(db, user_id)
         db.commit()
+        token_versions.set_min_version(user_id, version)
         return {"status": "ok", "message": "User promoted to artisan", "artisan_id": user_id}
     except DBAPIError:
         db.rollback()
@@ -860,7 +1891,10 @@ async def promote_to_customer(
     try:
         db.execute(text('INSERT INTO Customer(customer_id) VALUES(:uid)'), {
                    "uid": user_id})
+        # Existing tokens carry the old role
+        version = bump_token_version(db, user_id)
         db.commit()
+        token_versions.set_min_version(user_id, version)
         return {"status": "ok", "message": "User promoted to customer/buyer", "customer_id": user_id}
     except DBAPIError:
         db.rollback()
@@ -869,41 +1903,309 @@ async def promote_to_customer(
 
 
 # --- READ FUNCTIONALITY: GET ALL PRODUCTS (R) ---
-@app.get("/products", response_model=List[ProductDisplay], tags=["Product Catalog"])
-def read_products(db: Session = Depends(get_db)):
-    """Fetches all products from the database for display."""
+PRODUCT_PAGE_DEFAULT = 60
+PRODUCT_PAGE_MAX = 200
+# Column order of the product listing/search/export statements
+PRODUCT_COLUMNS = ("product_id", "name", "price", "stock_quantity", "cultural_motif",
+                   "artisan_id", "seller_email", "image_url", "description")
+
+
+def product_rows_to_dicts(rows) -> list:
+    return [dict(zip(PRODUCT_COLUMNS, row), thumbnail_url=thumbnail_url(row[7])) for row in rows]
+
+
+def catalog_response(page: CatalogPage, if_none_match: Optional[str]) -> Response:
+    """Serve a cached page, or 304 when the client already holds it."""
+    headers = {"ETag": page.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if page.next_cursor:
+        headers["X-Next-Cursor"] = page.next_cursor
+    # If-None-Match uses the weak comparison, so a W/ prefix is ignored
+    if if_none_match and page.etag[2:] in (tag.strip().removeprefix("W/")
+                                            for tag in if_none_match.split(",")):
+        catalog_cache.record_not_modified()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=page.body, media_type="application/json", headers=headers)
+
+
+@app.get("/products", response_model=List[ProductDisplay], response_class=FastJSONResponse,
+         tags=["Product Catalog"])
+async def read_products(
+    limit: int = Query(PRODUCT_PAGE_DEFAULT, ge=1, le=PRODUCT_PAGE_MAX),
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor from the previous page"),
+    motif: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    artisan_id: Optional[int] = None,
+    in_stock: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Fetches one page of products, newest first.
+
+    When more products follow, the X-Next-Cursor response header carries the
+    cursor for the next page. Pages are served from the catalog cache with an
+    ETag; a matching If-None-Match gets 304 without touching the database.
+    """
+    params = {
+        "cursor": cursor, "motif": motif, "min_price": min_price,
+        "max_price": max_price, "artisan_id": artisan_id
+    }
+    params = {key: value for key, value in params.items() if value is not None}
+    filters = set(params)
+    if in_stock:
+        filters.add("in_stock")
+
+    cache_key = (limit, in_stock, tuple(sorted(params.items())))
+    page = catalog_cache.get(cache_key)
+    if page is not None:
+        return catalog_response(page, if_none_match)
+
+    # Taken before the query so a concurrent bump discards this page
+    version = catalog_cache.version
+    # One extra row tells us whether there is a next page
+    params["limit"] = limit + 1
+
     try:
-        query = text("""
-            SELECT 
-                p.product_id, p.name, p.price, p.stock_quantity, p.cultural_motif, p.artisan_id,
-                u.email as seller_email, p.image_url, p.description
-            FROM Product p
-            JOIN "User" u ON p.artisan_id = u.user_id
-            ORDER BY p.product_id DESC
-        """)
-        products = db.execute(query).fetchall()
-
-        # Convert list of SQL rows to list of dicts with seller info
-        return [
-            {
-                "product_id": row[0],
-                "name": row[1],
-                "price": float(row[2]),
-                "stock_quantity": row[3],
-                "cultural_motif": row[4],
-                "artisan_id": row[5],
-                "seller_email": row[6],
-                "image_url": row[7],
-                "description": row[8]
-            } for row in products
-        ]
+        products = (await db.execute(
+            queries.product_listing(frozenset(filters)), params)).fetchall()
     except Exception as e:
         print(f"Database Read Error: {e}")
         raise HTTPException(
             status_code=500, detail="Failed to retrieve products.")
 
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        next_cursor = str(products[-1][0])
+
+    body = fast_dumps(product_rows_to_dicts(products))
+
+    page = CatalogPage(version, body, next_cursor)
+    catalog_cache.put(cache_key, page)
+    return catalog_response(page, if_none_match)
+
+
+# --- CATALOG FACETS ---
+# Upper edges of the price bands shown to buyers (Tk)
+PRICE_BAND_EDGES = (500, 1000, 2500, 5000, 10000)
+
+
+def price_band_label(band: int) -> str:
+    edges = (0,) + PRICE_BAND_EDGES
+    if band >= len(edges):
+        return f"{edges[-1]}+"
+    return f"{edges[band - 1]}-{edges[band]}"
+
+
+@app.get("/products/facets", tags=["Product Catalog"])
+async def read_product_facets(
+    motif: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    artisan_id: Optional[int] = None,
+    in_stock: bool = False,
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Product counts per motif, price band and artisan village.
+
+    Takes the same filters as GET /products and is served from the facet cache.
+    """
+    params = {
+        "motif": motif, "min_price": min_price,
+        "max_price": max_price, "artisan_id": artisan_id
+    }
+    params = {key: value for key, value in params.items() if value is not None}
+    filters = set(params)
+    if in_stock:
+        filters.add("in_stock")
+
+    cache_key = tuple(sorted(params.items())) + (("in_stock", in_stock),)
+    facets = facet_cache.get(cache_key)
+    if facets is not None:
+        return facets
+
+    generation = facet_cache.generation()
+    params["edges"] = list(PRICE_BAND_EDGES)
+    try:
+        rows = (await db.execute(
+            queries.product_facets(frozenset(filters)), params)).fetchall()
+    except Exception as e:
+        print(f"Database Facet Error: {e}")
+        raise HTTPException(
+            status_code=500, detail="Failed to count products.")
+
+    facets = {"total": 0, "motifs": {}, "price_bands": {}, "villages": {}}
+    for motif_value, village, band, grouping, count in rows:
+        # GROUPING() bits: motif=4, village=2, band=1 (1 = not grouped by it)
+        if grouping == 7:
+            facets["total"] = count
+        elif grouping == 3:
+            facets["motifs"][motif_value or "Unspecified"] = count
+        elif grouping == 5:
+            facets["villages"][village or "Unspecified"] = count
+        elif grouping == 6:
+            facets["price_bands"][price_band_label(band)] = count
+
+    facet_cache.put(cache_key, generation, facets)
+    return facets
+
+
+# --- CATALOG EXPORT ---
+PRODUCT_EXPORT_BATCH_SIZE = int(os.getenv("PRODUCT_EXPORT_BATCH_SIZE", "1000"))
+
+
+def stream_product_export():
+    """Yield the catalog as NDJSON, one fetched batch at a time.
+
+    Runs a server-side cursor on the replica (or primary), so memory use
+    depends on the batch size rather than on the size of the catalog.
+    """
+    sessions = get_read_db()
+    db = next(sessions)
+    try:
+        result = db.execute(queries.PRODUCT_EXPORT, execution_options={
+            "stream_results": True, "yield_per": PRODUCT_EXPORT_BATCH_SIZE})
+        for batch in result.partitions():
+            yield b"".join(fast_dumps(row) + b"\n" for row in product_rows_to_dicts(batch))
+    finally:
+        sessions.close()
+
+
+@app.get("/products/export", tags=["Product Catalog"])
+def export_products(format: str = Query("ndjson", description="Only 'ndjson' is supported")):
+    """Stream the whole catalog as newline-delimited JSON for aggregator partners."""
+    if format != "ndjson":
+        raise HTTPException(
+            status_code=400, detail="Unsupported export format. Use format=ndjson.")
+    return StreamingResponse(
+        stream_product_export(), media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="products.ndjson"'})
+
+
+@app.get("/products/search", response_model=List[ProductDisplay], response_class=FastJSONResponse,
+         tags=["Product Catalog"])
+async def search_products(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(PRODUCT_PAGE_DEFAULT, ge=1, le=PRODUCT_PAGE_MAX),
+    cursor: Optional[int] = Query(None, ge=0, description="X-Next-Cursor from the previous page"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Full-text search over name, description and motif, best matches first.
+
+    Ranked results are paged by position; X-Next-Cursor is set when more follow.
+    """
+    offset = cursor or 0
+    try:
+        products = (await db.execute(queries.PRODUCT_SEARCH, {
+            'q': q, 'limit': limit + 1, 'offset': offset})).fetchall()
+    except Exception as e:
+        print(f"Database Search Error: {e}")
+        raise HTTPException(
+            status_code=500, detail="Failed to search products.")
+
+    headers = {}
+    if len(products) > limit:
+        products = products[:limit]
+        headers["X-Next-Cursor"] = str(offset + limit)
+
+    return FastJSONResponse(product_rows_to_dicts(products), headers=headers)
+
 
 # --- CRITICAL INVENTORY LOCKING LOGIC ---
+# "atomic" claims stock with one conditional UPDATE (queries.PURCHASE_ATOMIC):
+# concurrent buyers of a hot product queue briefly on the row instead of
+# being refused. "lock" keeps the original SELECT ... FOR UPDATE NOWAIT flow,
+# which fails fast with a concurrency error while another purchase holds it.
+PURCHASE_STOCK_MODE = os.getenv("PURCHASE_STOCK_MODE", "atomic").lower()
+PURCHASE_MAX_RETRIES = int(os.getenv("PURCHASE_MAX_RETRIES", "3"))
+# serialization_failure, deadlock_detected, lock_not_available
+RETRYABLE_SQLSTATES = {"40001", "40P01", "55P03"}
+
+
+def new_transaction_id(payment_method: str) -> str:
+    """METHOD-<unix seconds>-<8 random digits>.
+
+    With the single-statement purchase (PURCHASE_ATOMIC) many purchases of
+    one product commit within the same second, so the random part is wide
+    enough to make "Transaction" primary key collisions negligible.
+    """
+    return f"{payment_method.upper()}-{int(datetime.now().timestamp())}-{random.randint(10**7, 10**8 - 1)}"
+
+
+def sqlstate(db_error: DBAPIError):
+    """SQLSTATE of a driver error, for both psycopg2 and asyncpg."""
+    orig = getattr(db_error, 'orig', None)
+    return getattr(orig, 'sqlstate', None) or getattr(orig, 'pgcode', None)
+
+
+async def run_purchase_statement(db: AsyncSession, statement, params: dict,
+                                 guard: Optional[IdempotencyGuard] = None, respond=None):
+    """Run a single-statement purchase and commit it.
+
+    Transient conflicts are retried up to PURCHASE_MAX_RETRIES times with a
+    short jittered backoff. Returns the result row, or None (rolled back)
+    when the statement matched nothing. With a guard, its key is claimed in
+    the same transaction and respond(row) is stored before the commit.
+    """
+    attempt = 0
+    while True:
+        try:
+            if guard is not None:
+                await guard.claim(db)
+            row = (await db.execute(statement, params)).fetchone()
+            if row is None:
+                await db.rollback()
+                return None
+            if guard is not None:
+                await guard.store(db, respond(row))
+            await db.commit()
+            catalog_changed(row[3])
+            return row
+        except DBAPIError as db_error:
+            await db.rollback()
+            if sqlstate(db_error) not in RETRYABLE_SQLSTATES or attempt >= PURCHASE_MAX_RETRIES:
+                raise
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+
+async def atomic_purchase(db: AsyncSession, product_id: int, quantity: int,
+                          customer_id: int, trans_id: str, payment_method: str,
+                          guard: Optional[IdempotencyGuard] = None, respond=None):
+    """Claim stock and record the purchase with queries.PURCHASE_ATOMIC.
+
+    Sharded products are bought from their stock slots instead.
+    Returns (order_id, price, total_amount, artisan_id).
+    """
+    params = {'pid': product_id, 'qty': quantity, 'cid': customer_id,
+              'tid': trans_id, 'method': payment_method, 'date': datetime.now()}
+    row = await run_purchase_statement(db, queries.PURCHASE_ATOMIC, params, guard, respond)
+    if row is not None:
+        return row
+    product = (await db.execute(queries.PRODUCT_STOCK, {'pid': product_id})).fetchone()
+    await db.rollback()
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if product[1] > 0:
+        row = await sharded_purchase(db, params, product[1], guard, respond)
+        if row is not None:
+            return row
+        product = (await db.execute(queries.PRODUCT_STOCK, {'pid': product_id})).fetchone()
+        await db.rollback()
+    raise HTTPException(
+        status_code=400, detail=f"Insufficient stock. Available: {product[0]}")
+
+
+async def sharded_purchase(db: AsyncSession, params: dict, shards: int,
+                           guard: Optional[IdempotencyGuard] = None, respond=None):
+    """Buy from one random free slot, else across all slots. None when short."""
+    row = await run_purchase_statement(db, queries.PURCHASE_FROM_SLOT, {
+        **params, 'start': random.randrange(shards)}, guard, respond)
+    if row is None:
+        row = await run_purchase_statement(db, queries.PURCHASE_FROM_SLOTS, params, guard, respond)
+    return row
+
+
 class PurchaseRequest(BaseModel):
     product_id: int
     user_id: int
@@ -911,25 +2213,46 @@ class PurchaseRequest(BaseModel):
 
 
 @app.post("/purchase/lock", tags=["Transaction"])
-def lock_item_for_purchase(request: PurchaseRequest, db: Session = Depends(get_db)):
+async def lock_item_for_purchase(
+    request: PurchaseRequest,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db)
+):
     """
     CRITICAL INTEGRITY LOGIC: Handles LOCK, Transaction, and Stock Update.
     """
+    trans_id = new_transaction_id("bkash")
+    guard = idempotency_guard(idempotency_key, request.user_id, "purchase_lock", request.model_dump())
+
+    def respond(order_id):
+        return {"status": "success", "message": "Item secured and purchased!", "product_id": request.product_id, "order_id": order_id}
+
     try:
-        # --- PHASE 1: LOCK AND CHECK ---
-        query = text("""
-            SELECT product_id, price, stock_quantity 
-            FROM Product 
-            WHERE product_id = :pid 
-            FOR UPDATE NOWAIT
-        """)
+        if guard is not None:
+            await guard.check(db)
+        if PURCHASE_STOCK_MODE == "atomic":
+            row = await atomic_purchase(db, request.product_id, 1, request.user_id,
+                                        trans_id, request.payment_method,
+                                        guard, lambda row: respond(row[0]))
+            return respond(row[0])
 
-        product_result = db.execute(
-            query, {'pid': request.product_id}).fetchone()
+        # --- PHASE 1: LOCK AND CHECK ---
+        if guard is not None:
+            await guard.claim(db)
+        product_result = (await db.execute(
+            queries.LOCK_PRODUCT_FOR_PURCHASE, {'pid': request.product_id})).fetchone()
 
         if not product_result:
             raise HTTPException(status_code=404, detail="Product not found.")
 
+        if product_result[4] > 0:
+            # Sharded stock is not on the Product row; buy from the slots
+            await db.rollback()
+            row = await atomic_purchase(db, request.product_id, 1, request.user_id,
+                                        trans_id, request.payment_method,
+                                        guard, lambda row: respond(row[0]))
+            return respond(row[0])
+
         current_stock = product_result[2]
 
         if current_stock < 1:
@@ -942,24 +2265,11 @@ def lock_item_for_purchase(request: PurchaseRequest, db: Session = Depends(get_d
         # --- PHASE 2: CREATE ORDER AND TRANSACTION RECORDS ---
 
         # 1. Create Order Record (Requires Customer FK verification)
-        insert_order_query = text("""
-            INSERT INTO "Order" (customer_id, order_date, status)
-            VALUES (:cid, :date, 'Pending Shipment')
-            RETURNING order_id;
-        """)
-
-        new_order_id = db.execute(insert_order_query, {
-                                  'cid': request.user_id, 'date': datetime.now()}).scalar_one()
+        new_order_id = (await db.execute(queries.INSERT_ORDER, {
+                                  'cid': request.user_id, 'date': datetime.now()})).scalar_one()
 
         # 2. Create Transaction Record (Requires Order FK verification)
-        trans_id = f"BKASH-{int(datetime.now().timestamp())}-{random.randint(1000, 9999)}"
-
-        insert_transaction_query = text("""
-            INSERT INTO "Transaction" (transaction_id, order_id, amount, payment_method, transaction_date)
-            VALUES (:tid, :oid, :amount, :method, :date);
-        """)
-
-        db.execute(insert_transaction_query, {
+        await db.execute(queries.INSERT_TRANSACTION, {
             'tid': trans_id,
             'oid': new_order_id,
             'amount': product_price,
@@ -968,21 +2278,23 @@ def lock_item_for_purchase(request: PurchaseRequest, db: Session = Depends(get_d
         })
 
         # 3. Update Product Stock (Releases the lock implicitly before commit)
-        update_query = text(
-            "UPDATE Product SET stock_quantity = stock_quantity - 1 WHERE product_id = :pid")
-        db.execute(update_query, {'pid': request.product_id})
+        await db.execute(queries.DECREMENT_STOCK, {
+                   'qty': 1, 'pid': request.product_id})
 
         # --- PHASE 3: COMMIT (Releases the Lock and Finalizes Transaction) ---
-        db.commit()
+        if guard is not None:
+            await guard.store(db, respond(new_order_id))
+        await db.commit()
+        catalog_changed(product_result[3])
 
-        return {"status": "success", "message": "Item secured and purchased!", "product_id": request.product_id, "order_id": new_order_id}
+        return respond(new_order_id)
 
     except HTTPException as http_ex:
-        db.rollback()
+        await db.rollback()
         raise http_ex
 
     except DBAPIError as db_error:
-        db.rollback()
+        await db.rollback()
         error_message = str(db_error.orig)
 
         # Handle specific concurrency error returned by PostgreSQL
@@ -990,7 +2302,7 @@ def lock_item_for_purchase(request: PurchaseRequest, db: Session = Depends(get_d
             raise HTTPException(
                 status_code=400, detail="CONCURRENCY ERROR: Item is currently locked by another buyer. Try again.")
 
-        if isinstance(db_error.orig, ForeignKeyViolation):
+        if sqlstate(db_error) == "23503":
             raise HTTPException(
                 status_code=400, detail="INTEGRITY ERROR: Missing required Customer/Artisan data. Run SQL setup script.")
 
@@ -999,7 +2311,7 @@ def lock_item_for_purchase(request: PurchaseRequest, db: Session = Depends(get_d
             status_code=500, detail="System integrity error during transaction. Check server logs.")
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"--- UNEXPECTED FAIL ---: {e}")
         raise HTTPException(
             status_code=500, detail=f"Unexpected system error: {e}")
@@ -1016,25 +2328,54 @@ class BuyerPurchaseRequest(BaseModel):
 @app.post("/buyer/purchase", tags=["Buyer"])
 async def buyer_purchase(
     request: BuyerPurchaseRequest,
+    idempotency_key: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Buyer makes a purchase with quantity and payment calculation."""
     await verify_role(current_user, "buyer")
+    if request.quantity < 1:
+        raise HTTPException(status_code=400, detail="Quantity must be at least 1.")
+
+    # Generate transaction ID
+    trans_id = new_transaction_id(request.payment_method)
+    guard = idempotency_guard(idempotency_key, current_user['user_id'], "buyer_purchase",
+                              request.model_dump())
+
+    def respond(order_id, total_amount):
+        return {
+            "status": "success",
+            "transaction_id": trans_id,
+            "order_id": order_id,
+            "total_amount": total_amount
+        }
 
     try:
+        if guard is not None:
+            await guard.check(db)
+        if PURCHASE_STOCK_MODE == "atomic":
+            row = await atomic_purchase(db, request.product_id, request.quantity,
+                                        current_user['user_id'], trans_id, request.payment_method,
+                                        guard, lambda row: respond(row[0], row[2]))
+            return respond(row[0], row[2])
+
         # Lock and get product
-        query = text("""
-            SELECT product_id, price, stock_quantity, artisan_id
-            FROM Product 
-            WHERE product_id = :pid 
-            FOR UPDATE NOWAIT
-        """)
-        product = db.execute(query, {'pid': request.product_id}).fetchone()
+        if guard is not None:
+            await guard.claim(db)
+        product = (await db.execute(
+            queries.LOCK_PRODUCT_FOR_PURCHASE, {'pid': request.product_id})).fetchone()
 
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
 
+        if product[4] > 0:
+            # Sharded stock is not on the Product row; buy from the slots
+            await db.rollback()
+            row = await atomic_purchase(db, request.product_id, request.quantity,
+                                        current_user['user_id'], trans_id, request.payment_method,
+                                        guard, lambda row: respond(row[0], row[2]))
+            return respond(row[0], row[2])
+
         if product[2] < request.quantity:
             raise HTTPException(
                 status_code=400, detail=f"Insufficient stock. Available: {product[2]}")
@@ -1043,25 +2384,13 @@ async def buyer_purchase(
         total_amount = float(product[1]) * request.quantity
 
         # Create order
-        insert_order = text("""
-            INSERT INTO "Order" (customer_id, order_date, status)
-            VALUES (:cid, :date, 'Pending Shipment')
-            RETURNING order_id;
-        """)
-        order_id = db.execute(insert_order, {
+        order_id = (await db.execute(queries.INSERT_ORDER, {
             'cid': current_user['user_id'],
             'date': datetime.now()
-        }).scalar_one()
-
-        # Generate transaction ID
-        trans_id = f"{request.payment_method.upper()}-{int(datetime.now().timestamp())}-{random.randint(1000, 9999)}"
+        })).scalar_one()
 
         # Create transaction
-        insert_transaction = text("""
-            INSERT INTO "Transaction" (transaction_id, order_id, amount, payment_method, transaction_date)
-            VALUES (:tid, :oid, :amount, :method, :date);
-        """)
-        db.execute(insert_transaction, {
+        await db.execute(queries.INSERT_TRANSACTION, {
             'tid': trans_id,
             'oid': order_id,
             'amount': total_amount,
@@ -1070,11 +2399,7 @@ async def buyer_purchase(
         })
 
         # Create order item to track product purchase
-        insert_order_item = text("""
-            INSERT INTO OrderItem (order_id, product_id, quantity, price)
-            VALUES (:oid, :pid, :qty, :price);
-        """)
-        db.execute(insert_order_item, {
+        await db.execute(queries.INSERT_ORDER_ITEM, {
             'oid': order_id,
             'pid': request.product_id,
             'qty': request.quantity,
@@ -1082,28 +2407,27 @@ async def buyer_purchase(
         })
 
         # Update stock
-        update_stock = text(
-            "UPDATE Product SET stock_quantity = stock_quantity - :qty WHERE product_id = :pid")
-        db.execute(update_stock, {
-                   'qty': request.quantity, 'pid': request.product_id})
+        await db.execute(queries.DECREMENT_STOCK, {
+            'qty': request.quantity, 'pid': request.product_id})
 
-        db.commit()
+        if guard is not None:
+            await guard.store(db, respond(order_id, total_amount))
+        await db.commit()
+        catalog_changed(product[3])
 
-        return {
-            "status": "success",
-            "transaction_id": trans_id,
-            "order_id": order_id,
-            "total_amount": total_amount
-        }
+        return respond(order_id, total_amount)
 
     except HTTPException:
-        db.rollback()
+        await db.rollback()
         raise
     except DBAPIError as db_error:
-        db.rollback()
+        await db.rollback()
         from psycopg2.errors import ForeignKeyViolation as PGFKV
         msg = str(db_error.orig) if getattr(
             db_error, 'orig', None) else str(db_error)
+        if sqlstate(db_error) in RETRYABLE_SQLSTATES:
+            raise HTTPException(
+                status_code=409, detail="This item is in high demand. Please try again.")
         if isinstance(getattr(db_error, 'orig', None), PGFKV) or 'foreign key' in msg.lower():
             raise HTTPException(
                 status_code=400, detail="Purchase integrity error. Your account may not be a buyer or product/order references are invalid.")
@@ -1117,11 +2441,292 @@ async def buyer_purchase(
         raise HTTPException(
             status_code=500, detail="Purchase failed due to database error")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Purchase error: {e}")
         raise HTTPException(status_code=500, detail="Purchase failed")
 
 
+# --- CART CHECKOUT ---
+CHECKOUT_MAX_ITEMS = 100
+CHECKOUT_LOCK_TIMEOUT_MS = int(os.getenv("CHECKOUT_LOCK_TIMEOUT_MS", "5000"))
+
+
+class CartItem(BaseModel):
+    product_id: int
+    quantity: int
+
+
+class CheckoutRequest(BaseModel):
+    items: List[CartItem]
+    payment_method: str
+
+
+@app.post("/buyer/checkout", tags=["Buyer"])
+async def buyer_checkout(
+    request: CheckoutRequest,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Buy every item in the cart as one order, one transaction, one commit."""
+    await verify_role(current_user, "buyer")
+
+    # Merge repeated products so each row is locked and decremented once
+    quantities = {}
+    for item in request.items:
+        if item.quantity < 1:
+            raise HTTPException(
+                status_code=400, detail=f"Quantity must be at least 1 (product {item.product_id}).")
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    if not quantities:
+        raise HTTPException(status_code=400, detail="Cart is empty.")
+    if len(quantities) > CHECKOUT_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {CHECKOUT_MAX_ITEMS} different products per checkout.")
+    product_ids = sorted(quantities)
+    guard = idempotency_guard(idempotency_key, current_user['user_id'], "buyer_checkout",
+                              request.model_dump())
+
+    try:
+        if guard is not None:
+            await guard.check(db)
+            await guard.claim(db)
+        await db.execute(queries.SET_LOCK_TIMEOUT, {'timeout': f"{CHECKOUT_LOCK_TIMEOUT_MS}ms"})
+        products = {row[0]: row for row in (await db.execute(
+            queries.LOCK_PRODUCTS_FOR_CHECKOUT, {'ids': product_ids})).fetchall()}
+
+        missing = [pid for pid in product_ids if pid not in products]
+        if missing:
+            raise HTTPException(
+                status_code=404, detail=f"Products not found: {missing}")
+        sharded = [pid for pid in product_ids if products[pid][4] > 0]
+        if sharded:
+            raise HTTPException(
+                status_code=409, detail=f"Flash-sale products must be bought on their own: {sharded}")
+        short = [{"product_id": pid, "requested": quantities[pid], "available": products[pid][2]}
+                 for pid in product_ids if products[pid][2] < quantities[pid]]
+        if short:
+            raise HTTPException(
+                status_code=400, detail={"message": "Insufficient stock.", "items": short})
+
+        total_amount = sum(products[pid][1] * quantities[pid] for pid in product_ids)
+
+        order_id = (await db.execute(queries.INSERT_ORDER, {
+            'cid': current_user['user_id'],
+            'date': datetime.now()
+        })).scalar_one()
+
+        trans_id = new_transaction_id(request.payment_method)
+        await db.execute(queries.INSERT_TRANSACTION, {
+            'tid': trans_id,
+            'oid': order_id,
+            'amount': total_amount,
+            'method': request.payment_method,
+            'date': datetime.now()
+        })
+
+        # All order items and stock updates in one statement each
+        await db.execute(queries.INSERT_ORDER_ITEMS, {
+            'oid': order_id,
+            'pids': product_ids,
+            'qtys': [quantities[pid] for pid in product_ids],
+            'prices': [products[pid][1] for pid in product_ids]
+        })
+        await db.execute(queries.DECREMENT_STOCKS, {
+            'pids': product_ids,
+            'qtys': [quantities[pid] for pid in product_ids]
+        })
+
+        body = {
+            "status": "success",
+            "transaction_id": trans_id,
+            "order_id": order_id,
+            "total_amount": float(total_amount),
+            "items": [{"product_id": pid, "quantity": quantities[pid],
+                       "price": float(products[pid][1])} for pid in product_ids]
+        }
+        if guard is not None:
+            await guard.store(db, body)
+        await db.commit()
+        for artisan_id in {products[pid][3] for pid in product_ids}:
+            catalog_changed(artisan_id)
+
+        return body
+
+    except HTTPException:
+        await db.rollback()
+        raise
+    except DBAPIError as db_error:
+        await db.rollback()
+        msg = str(db_error.orig) if getattr(
+            db_error, 'orig', None) else str(db_error)
+        if 'lock timeout' in msg.lower():
+            raise HTTPException(
+                status_code=409, detail="Some items are being purchased by other buyers. Please try again.")
+        if 'foreign key' in msg.lower():
+            raise HTTPException(
+                status_code=400, detail="Checkout integrity error. Your account may not be a buyer.")
+        print(f"Checkout DB error: {msg}")
+        raise HTTPException(
+            status_code=500, detail="Checkout failed due to database error")
+
+
+# --- STOCK RESERVATIONS ---
+# A buyer holds stock while filling in payment details, then converts the
+# hold into an order. Holds count against availability everywhere.
+AVAILABILITY_MAX_IDS = 100
+
+
+class ReservationRequest(BaseModel):
+    product_id: int
+    quantity: int
+
+
+class ReservationPurchaseRequest(BaseModel):
+    payment_method: str
+
+
+@app.get("/products/availability", tags=["Product Catalog"])
+async def get_product_availability(
+    ids: Annotated[List[int], Query()],
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Stock not held by live reservations, read from the primary."""
+    if len(ids) > AVAILABILITY_MAX_IDS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {AVAILABILITY_MAX_IDS} products per request.")
+    rows = (await db.execute(queries.PRODUCT_AVAILABILITY, {'ids': sorted(set(ids))})).fetchall()
+    return FastJSONResponse(rows_to_dicts(
+        ("product_id", "stock_quantity", "reserved_quantity", "available"), rows))
+
+
+@app.post("/buyer/reservations", tags=["Buyer"])
+async def reserve_stock(
+    request: ReservationRequest,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Hold stock for RESERVATION_TTL_SECONDS. Replaces the buyer's current hold on the product."""
+    await verify_role(current_user, "buyer")
+    if request.quantity < 1:
+        raise HTTPException(status_code=400, detail="Quantity must be at least 1.")
+    params = {'pid': request.product_id, 'cid': current_user['user_id']}
+    try:
+        await db.execute(queries.RELEASE_PRODUCT_RESERVATION, params)
+        row = (await db.execute(queries.RESERVE_STOCK, {
+            **params, 'qty': request.quantity, 'ttl': RESERVATION_TTL_SECONDS})).fetchone()
+        if row is None:
+            await db.rollback()
+            product = (await db.execute(
+                queries.PRODUCT_STOCK, {'pid': request.product_id})).fetchone()
+            await db.rollback()
+            if product is None:
+                raise HTTPException(status_code=404, detail="Product not found")
+            if product[1] > 0:
+                raise HTTPException(
+                    status_code=409, detail="Flash-sale products cannot be reserved; buy them directly.")
+            raise HTTPException(
+                status_code=400, detail=f"Insufficient stock. Available: {product[0]}")
+        await db.commit()
+    except DBAPIError as db_error:
+        await db.rollback()
+        if sqlstate(db_error) in RETRYABLE_SQLSTATES | {"23505"}:
+            raise HTTPException(
+                status_code=409, detail="This item is in high demand. Please try again.")
+        print(f"Reservation DB error: {db_error}")
+        raise HTTPException(
+            status_code=500, detail="Reservation failed due to database error")
+
+    return {
+        "reservation_id": row[0],
+        "product_id": row[1],
+        "quantity": row[2],
+        "expires_at": row[3].isoformat(),
+        "ttl_seconds": RESERVATION_TTL_SECONDS
+    }
+
+
+@app.get("/buyer/reservations", tags=["Buyer"])
+async def get_buyer_reservations(
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """The buyer's live holds, soonest to expire first."""
+    await verify_role(current_user, "buyer")
+    rows = (await db.execute(
+        queries.BUYER_RESERVATIONS, {'cid': current_user['user_id']})).fetchall()
+    return FastJSONResponse(rows_to_dicts(
+        ("reservation_id", "product_id", "name", "quantity", "price", "expires_at"), rows))
+
+
+@app.delete("/buyer/reservations/{reservation_id}", tags=["Buyer"])
+async def release_reservation(
+    reservation_id: int,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Give held stock back before the hold expires."""
+    await verify_role(current_user, "buyer")
+    released = (await db.execute(queries.RELEASE_RESERVATION, {
+        'rid': reservation_id, 'cid': current_user['user_id']})).fetchone()
+    await db.commit()
+    if released is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return {"status": "released", "reservation_id": reservation_id}
+
+
+@app.post("/buyer/reservations/{reservation_id}/purchase", tags=["Buyer"])
+async def purchase_reservation(
+    reservation_id: int,
+    request: ReservationPurchaseRequest,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Convert a live hold into an order in one statement."""
+    await verify_role(current_user, "buyer")
+    trans_id = new_transaction_id(request.payment_method)
+    params = {'rid': reservation_id, 'cid': current_user['user_id']}
+    guard = idempotency_guard(idempotency_key, current_user['user_id'], "reservation_purchase",
+                              {"reservation_id": reservation_id, **request.model_dump()})
+
+    def respond(row):
+        return {
+            "status": "success",
+            "transaction_id": trans_id,
+            "order_id": row[0],
+            "product_id": row[4],
+            "quantity": row[5],
+            "total_amount": row[2]
+        }
+
+    try:
+        if guard is not None:
+            await guard.check(db)
+        row = await run_purchase_statement(db, queries.PURCHASE_RESERVATION, {
+            **params, 'tid': trans_id, 'method': request.payment_method,
+            'date': datetime.now()}, guard, respond)
+        if row is None:
+            live = (await db.execute(queries.RESERVATION_STATUS, params)).scalar_one_or_none()
+            await db.rollback()
+            if live is None:
+                raise HTTPException(status_code=404, detail="Reservation not found")
+            if not live:
+                raise HTTPException(status_code=410, detail="Reservation expired")
+            raise HTTPException(
+                status_code=409, detail="Reserved stock is no longer available.")
+    except DBAPIError as db_error:
+        await db.rollback()
+        if sqlstate(db_error) in RETRYABLE_SQLSTATES:
+            raise HTTPException(
+                status_code=409, detail="This item is in high demand. Please try again.")
+        print(f"Reservation purchase DB error: {db_error}")
+        raise HTTPException(
+            status_code=500, detail="Purchase failed due to database error")
+
+    return respond(row)
+
+
 @app.get("/buyer/orders", tags=["Buyer"])
 async def get_buyer_orders(
     current_user: dict = Depends(get_current_user),
@@ -1494,8 +3099,9 @@ async def get_artisan_products(
         return []
 
     query = text("""
-        SELECT product_id, name, price, stock_quantity, cultural_motif, artisan_id, image_url, description
-        FROM Product
+        SELECT product_id, name, price, total_stock(p), cultural_motif, artisan_id, image_url, description,
+               stock_shards
+        FROM Product p
         WHERE artisan_id = :aid
         ORDER BY product_id DESC
     """)
@@ -1510,7 +3116,9 @@ async def get_artisan_products(
             "cultural_motif": row[4],
             "artisan_id": row[5],
             "image_url": row[6],
-            "description": row[7]
+            "thumbnail_url": thumbnail_url(row[6]),
+            "description": row[7],
+            "stock_shards": row[8]
         } for row in products
     ]
 
@@ -1518,15 +3126,13 @@ async def get_artisan_products(
 @app.get("/artisan/stats", tags=["Artisan"])
 async def get_artisan_stats(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get artisan dashboard statistics."""
     await verify_role(current_user, "artisan")
 
-    artisan_query = text(
-        "SELECT artisan_id FROM Artisan WHERE artisan_id = :uid")
-    artisan = db.execute(
-        artisan_query, {'uid': current_user['user_id']}).fetchone()
+    artisan = (await db.execute(
+        queries.ARTISAN_EXISTS, {'uid': current_user['user_id']})).fetchone()
 
     if not artisan:
         return {"total_products": 0, "total_sales": 0, "pending_orders": 0, "completed_orders": 0, "wallet_balance": 0}
@@ -1535,25 +3141,11 @@ async def get_artisan_stats(
 
     # Get stats with conservative queries to avoid DB errors
     try:
-        total_products = db.execute(
-            text(
-                "SELECT COUNT(*) FROM Product WHERE artisan_id = :aid"), {"aid": aid}
-        ).scalar() or 0
-
-        # Calculate sales from OrderItem table
-        sales_query = text("""
-            SELECT 
-                COALESCE(SUM(t.amount), 0) as total_sales,
-                COUNT(DISTINCT CASE WHEN o.status = 'Pending Shipment' THEN o.order_id END) as awaiting_dispatch,
-                COUNT(DISTINCT CASE WHEN o.status = 'Shipped' THEN o.order_id END) as in_transit,
-                COUNT(DISTINCT CASE WHEN o.status = 'Delivered' THEN o.order_id END) as completed_orders
-            FROM Product p
-            LEFT JOIN OrderItem oi ON p.product_id = oi.product_id
-            LEFT JOIN "Order" o ON oi.order_id = o.order_id
-            LEFT JOIN "Transaction" t ON o.order_id = t.order_id
-            WHERE p.artisan_id = :aid
-        """)
-        sales_result = db.execute(sales_query, {"aid": aid}).fetchone()
+        total_products = (await db.execute(
+            queries.ARTISAN_PRODUCT_COUNT, {"aid": aid})).scalar() or 0
+
+        sales_result = (await db.execute(
+            queries.ARTISAN_SALES_SUMMARY, {"aid": aid})).fetchone()
 
         total_sales = float(sales_result[0]) if sales_result else 0.0
         awaiting_dispatch = int(sales_result[1]) if sales_result else 0
@@ -1642,7 +3234,7 @@ async def get_artisan_recent_sales(
 @app.get("/artisan/wallet", tags=["Artisan"])
 async def get_artisan_wallet(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get artisan wallet and transaction details."""
     await verify_role(current_user, "artisan")
@@ -1657,6 +3249,11 @@ async def get_artisan_wallet(
 
     aid = artisan[0]
 
+    if DB_JSON_AGGREGATION:
+        body = db.execute(queries.ARTISAN_WALLET_JSON, {
+            "aid": aid, "rate": MARKETPLACE_COMMISSION_RATE}).scalar_one()
+        return Response(content=body.encode("utf-8"), media_type="application/json")
+
     # Get transactions related to this artisan through OrderItem
     transactions_query = text("""
         SELECT 
@@ -1841,6 +3438,7 @@ async def verify_user(
             "UPDATE \"User\" SET is_active = TRUE WHERE user_id = :uid")
         result = db.execute(query, {'uid': user_id})
         db.commit()
+        principal_cache.invalidate(user_id)
         return {"status": "success", "message": "User approved successfully"}
     except Exception as e:
         db.rollback()
@@ -1860,6 +3458,7 @@ async def verify_artisan(
             "UPDATE \"User\" SET is_active = TRUE WHERE user_id = :aid")
         result = db.execute(query, {'aid': artisan_id})
         db.commit()
+        principal_cache.invalidate(artisan_id)
         return {"status": "success", "message": "Artisan approved successfully"}
     except Exception as e:
         db.rollback()
@@ -1885,7 +3484,10 @@ async def reject_user(
         db.execute(text("DELETE FROM \"User\" WHERE user_id = :uid"), {
                    'uid': user_id})
 
+        # Committed with the delete, so other workers' token polls see it
+        db.execute(queries.REVOKE_USER, {'uid': user_id})
         db.commit()
+        token_versions.revoke_all(user_id)
         return {"status": "success", "message": "User rejected and removed from system"}
     except Exception as e:
         db.rollback()
@@ -1905,7 +3507,9 @@ async def reject_artisan(
         query = text(
             "UPDATE \"User\" SET is_active = FALSE WHERE user_id = :aid")
         result = db.execute(query, {'aid': artisan_id})
+        version = bump_token_version(db, artisan_id)
         db.commit()
+        token_versions.set_min_version(artisan_id, version)
         return {"status": "success", "message": "Artisan rejected successfully"}
     except Exception as e:
         db.rollback()
@@ -1923,42 +3527,40 @@ async def suspend_artisan(
         query = text(
             "UPDATE \"User\" SET is_active = FALSE WHERE user_id = :aid")
         db.execute(query, {'aid': artisan_id})
+        version = bump_token_version(db, artisan_id)
         db.commit()
+        token_versions.set_min_version(artisan_id, version)
         return {"status": "success"}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail="Suspension failed")
 
 
-@app.get("/admin/audit-logs", tags=["Admin"])
+@app.get("/admin/audit-logs", tags=["Admin"], response_class=FastJSONResponse)
 async def get_audit_logs(
     current_user: dict = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """Get transaction audit logs."""
+    if DB_JSON_AGGREGATION:
+        body = db.execute(queries.AUDIT_LOGS_JSON).scalar_one()
+        return Response(content=body.encode("utf-8"), media_type="application/json")
+
     query = text("""
-        SELECT transaction_id, order_id, amount, payment_method, transaction_date
+        SELECT transaction_id, order_id, amount::float8 AS amount, payment_method, transaction_date
         FROM "Transaction"
         ORDER BY transaction_date DESC
         LIMIT 100
     """)
-    logs = db.execute(query).fetchall()
+    logs = db.execute(query)
 
-    return [
-        {
-            "transaction_id": row[0],
-            "order_id": row[1],
-            "amount": float(row[2]),
-            "payment_method": row[3],
-            "transaction_date": row[4].isoformat()
-        } for row in logs
-    ]
+    return FastJSONResponse(rows_to_dicts(logs.keys(), logs.fetchall()))
 
 
 @app.get("/admin/payout-ledger", tags=["Admin"])
 async def get_payout_ledger(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get artisan payout ledger."""
     query = text("""
@@ -2080,21 +3682,26 @@ async def get_seller_financial_info(
     }
 
 
-@app.get("/admin/all-sellers-financial", tags=["Admin"])
+@app.get("/admin/all-sellers-financial", tags=["Admin"], response_class=FastJSONResponse)
 async def get_all_sellers_financial(
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get financial overview of all sellers/artisans."""
     await verify_role(current_user, "admin")
 
+    if DB_JSON_AGGREGATION:
+        body = db.execute(queries.ALL_SELLERS_FINANCIAL_JSON, {
+            "rate": MARKETPLACE_COMMISSION_RATE}).scalar_one()
+        return Response(content=body.encode("utf-8"), media_type="application/json")
+
     sellers_query = text("""
         SELECT 
             a.artisan_id,
             u.email,
             u.registration_date,
             COUNT(DISTINCT p.product_id) as total_products,
-            COALESCE(SUM(t.amount), 0) as total_revenue,
+            COALESCE(SUM(t.amount), 0)::float8 as total_revenue,
             COUNT(DISTINCT o.order_id) as total_orders
         FROM Artisan a
         JOIN "User" u ON a.artisan_id = u.user_id
@@ -2109,18 +3716,18 @@ async def get_all_sellers_financial(
 
     sellers = db.execute(sellers_query).fetchall()
 
-    return [
+    return FastJSONResponse([
         {
             "artisan_id": seller[0],
             "email": seller[1],
-            "registration_date": seller[2].isoformat() if seller[2] else None,
-            "total_products": int(seller[3]),
-            "total_revenue": float(seller[4]),
-            "marketplace_commission": float(seller[4]) * MARKETPLACE_COMMISSION_RATE,
-            "net_earnings": float(seller[4]) * (1 - MARKETPLACE_COMMISSION_RATE),
-            "total_orders": int(seller[5])
+            "registration_date": seller[2],
+            "total_products": seller[3],
+            "total_revenue": seller[4],
+            "marketplace_commission": seller[4] * MARKETPLACE_COMMISSION_RATE,
+            "net_earnings": seller[4] * (1 - MARKETPLACE_COMMISSION_RATE),
+            "total_orders": seller[5]
         } for seller in sellers
-    ]
+    ])
 
 # ==================== TRACKING BY COURIER ID (BUYER) ====================
 
@@ -0,0 +1,107 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# --- Password Hashing Pool Settings ---
+# bcrypt takes 100-300 ms per call by design, so it runs in worker processes
+# instead of on the event loop. Concurrency is capped at the worker count by
+# default, and callers beyond the queue limit are turned away immediately.
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(min(os.cpu_count() or 1, 4))))
+PASSWORD_HASH_MAX_CONCURRENCY = int(
+    os.getenv("PASSWORD_HASH_MAX_CONCURRENCY", str(PASSWORD_HASH_WORKERS)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+
+def hash_password_sync(plain_password: str) -> str:
+    """Hashes a password with a fresh bcrypt salt. Runs inside a pool worker."""
+    return bcrypt.hashpw(plain_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+
+def verify_password_sync(plain_password: str, hashed_password: str) -> bool:
+    """Checks a password against a bcrypt hash. Runs inside a pool worker."""
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def _warm_worker() -> int:
+    """No-op task used to spawn a worker and import bcrypt in it."""
+    return os.getpid()
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full and the caller should retry later."""
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool with a concurrency cap and bounded queue."""
+
+    def __init__(self, workers: int, max_concurrency: int, max_queue: int):
+        self.workers = max(1, workers)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        """Create the worker pool. Called at startup; otherwise done on first use."""
+        if self._executor is None:
+            # "spawn" keeps workers from inheriting the server's threads and
+            # open database sockets.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self._pending += 1
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self.start(), fn, *args)
+                self.completed += 1
+                return result
+        finally:
+            self._pending -= 1
+
+    async def warm(self):
+        """Spawn every worker up front instead of on the first logins."""
+        loop = asyncio.get_running_loop()
+        executor = self.start()
+        await asyncio.gather(*[loop.run_in_executor(executor, _warm_worker)
+                               for _ in range(self.workers)])
+
+    async def hash(self, plain_password: str) -> str:
+        return await self._run(hash_password_sync, plain_password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password_sync, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        in_flight = min(self._pending, self.max_concurrency)
+        return {
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": in_flight,
+            "queued": self._pending - in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+
+
+password_hasher = PasswordHasher(
+    PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_CONCURRENCY, PASSWORD_HASH_MAX_QUEUE)
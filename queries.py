@@ -0,0 +1,701 @@
+from functools import lru_cache
+
+from sqlalchemy.sql import text
+
+# --- PRECOMPILED QUERY CATALOG ---
+# Listing statements return money as float8 so rows can be serialized as-is
+# (see fastjson.py).
+# Hot-path statements are built once at import time rather than per request.
+# SQLAlchemy reuses their compiled form, and on the asyncpg engine each one
+# becomes a server-side prepared statement cached per pooled connection, so
+# Postgres parses and plans it once per connection instead of once per call.
+CATALOG = {}
+
+
+def _statement(name: str, sql: str):
+    stmt = text(sql)
+    CATALOG[name] = stmt
+    return stmt
+
+
+# --- Authentication ---
+
+AUTHENTICATE_USER = _statement("authenticate_user", """
+    SELECT u.user_id, u.email, u.password_hash, COALESCE(u.is_active, TRUE),
+           CASE WHEN a.artisan_id IS NOT NULL THEN 'artisan'
+                WHEN c.customer_id IS NOT NULL THEN 'buyer'
+           END AS role,
+           u.token_version
+    FROM "User" u
+    LEFT JOIN Artisan a ON a.artisan_id = u.user_id
+    LEFT JOIN Customer c ON c.customer_id = u.user_id
+    WHERE u.email = :email
+""")
+
+# Same row without the version, for databases without add_token_version.sql
+AUTHENTICATE_USER_UNVERSIONED = _statement("authenticate_user_unversioned", """
+    SELECT u.user_id, u.email, u.password_hash, COALESCE(u.is_active, TRUE),
+           CASE WHEN a.artisan_id IS NOT NULL THEN 'artisan'
+                WHEN c.customer_id IS NOT NULL THEN 'buyer'
+           END AS role,
+           CAST(NULL AS INT)
+    FROM "User" u
+    LEFT JOIN Artisan a ON a.artisan_id = u.user_id
+    LEFT JOIN Customer c ON c.customer_id = u.user_id
+    WHERE u.email = :email
+""")
+
+USER_STATUS_BY_EMAIL = _statement("user_status_by_email", """
+    SELECT user_id, is_active FROM "User" WHERE email = :email
+""")
+
+# Role is resolved with one primary-key lookup per table instead of three
+# separate round-trips.
+PRINCIPAL_BY_ID = _statement("principal_by_id", """
+    SELECT u.user_id, u.email,
+           CASE WHEN a.artisan_id IS NOT NULL THEN 'artisan'
+                WHEN c.customer_id IS NOT NULL THEN 'buyer'
+           END AS role
+    FROM "User" u
+    LEFT JOIN Artisan a ON a.artisan_id = u.user_id
+    LEFT JOIN Customer c ON c.customer_id = u.user_id
+    WHERE u.user_id = :uid AND u.is_active = TRUE
+""")
+
+# Rejected (deleted) users come from RevokedUser with the largest version, so
+# none of their tokens is accepted again
+TOKEN_VERSION_CHANGES = _statement("token_version_changes", """
+    SELECT user_id, token_version, token_version_updated_at
+    FROM "User"
+    WHERE token_version_updated_at > :since
+    UNION ALL
+    SELECT user_id, 2147483647, revoked_at
+    FROM RevokedUser
+    WHERE revoked_at > :since
+""")
+
+REVOKE_USER = _statement("revoke_user", """
+    INSERT INTO RevokedUser (user_id, revoked_at)
+    VALUES (:uid, clock_timestamp())
+    ON CONFLICT (user_id) DO UPDATE SET revoked_at = EXCLUDED.revoked_at
+""")
+
+BUMP_TOKEN_VERSION = _statement("bump_token_version", """
+    UPDATE "User"
+    SET token_version = token_version + 1,
+        token_version_updated_at = clock_timestamp()
+    WHERE user_id = :uid
+    RETURNING token_version
+""")
+
+# --- Product Catalog ---
+
+# Keyset pagination: each page continues below the last product_id seen, so
+# the cost of a page does not depend on how deep into the catalog it is.
+# One statement is built per combination of filters in use and then reused.
+PRODUCT_FILTERS = {
+    "cursor": "p.product_id < :cursor",
+    "motif": "p.cultural_motif = :motif",
+    "min_price": "p.price >= :min_price",
+    "max_price": "p.price <= :max_price",
+    "artisan_id": "p.artisan_id = :artisan_id",
+    # Matches the partial index; total_stock() then drops sold-out sharded rows
+    "in_stock": "(p.stock_quantity > 0 OR p.stock_shards > 0) AND total_stock(p) > 0",
+}
+
+
+@lru_cache(maxsize=None)
+def product_listing(filters: frozenset = frozenset()):
+    """Listing statement for the given PRODUCT_FILTERS keys, newest first."""
+    where = " AND ".join(PRODUCT_FILTERS[name] for name in sorted(filters))
+    name = "product_listing" + "".join(f"_{f}" for f in sorted(filters))
+    return _statement(name, f"""
+    SELECT
+        p.product_id, p.name, p.price::float8 AS price, total_stock(p) AS stock_quantity, p.cultural_motif, p.artisan_id,
+        u.email as seller_email, p.image_url, p.description
+    FROM Product p
+    JOIN "User" u ON p.artisan_id = u.user_id
+    {"WHERE " + where if where else ""}
+    ORDER BY p.product_id DESC
+    LIMIT :limit
+""")
+
+
+PRODUCT_LISTING = product_listing()
+
+
+@lru_cache(maxsize=None)
+def product_facets(filters: frozenset = frozenset()):
+    """Facet counts for the given PRODUCT_FILTERS keys in one grouped scan.
+
+    GROUPING SETS returns the per-motif, per-village, per-price-band and total
+    counts together; the grouping bitmask says which set each row belongs to.
+    """
+    where = " AND ".join(PRODUCT_FILTERS[name] for name in sorted(filters))
+    name = "product_facets" + "".join(f"_{f}" for f in sorted(filters))
+    return _statement(name, f"""
+    SELECT p.cultural_motif, a.village_origin, width_bucket(p.price, CAST(:edges AS NUMERIC[])) + 1 AS band,
+           GROUPING(p.cultural_motif, a.village_origin, width_bucket(p.price, CAST(:edges AS NUMERIC[])) + 1),
+           COUNT(*)
+    FROM Product p
+    JOIN Artisan a ON a.artisan_id = p.artisan_id
+    {"WHERE " + where if where else ""}
+    GROUP BY GROUPING SETS (
+        (p.cultural_motif), (a.village_origin),
+        (width_bucket(p.price, CAST(:edges AS NUMERIC[])) + 1), ()
+    )
+""")
+
+# Full catalog in ascending id order for /products/export, streamed through a
+# server-side cursor.
+PRODUCT_EXPORT = _statement("product_export", """
+    SELECT
+        p.product_id, p.name, p.price::float8 AS price, total_stock(p) AS stock_quantity, p.cultural_motif, p.artisan_id,
+        u.email as seller_email, p.image_url, p.description
+    FROM Product p
+    JOIN "User" u ON p.artisan_id = u.user_id
+    ORDER BY p.product_id
+""")
+
+# Full-text search (add_product_search.sql). The query is parsed with both
+# the stemming 'english' and the literal 'simple' configuration so English
+# and Bangla terms both hit the GIN index on search_vector.
+PRODUCT_SEARCH = _statement("product_search", """
+    SELECT
+        p.product_id, p.name, p.price::float8 AS price, total_stock(p) AS stock_quantity, p.cultural_motif, p.artisan_id,
+        u.email as seller_email, p.image_url, p.description,
+        ts_rank_cd(p.search_vector, q.query) AS rank
+    FROM (SELECT websearch_to_tsquery('english', :q) ||
+                 websearch_to_tsquery('simple', :q) AS query) q
+    JOIN Product p ON p.search_vector @@ q.query
+    JOIN "User" u ON p.artisan_id = u.user_id
+    ORDER BY rank DESC, p.product_id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+# Multi-row insert for bulk imports: one round-trip per chunk, with the
+# columns passed as parallel arrays.
+BULK_INSERT_PRODUCTS = _statement("bulk_insert_products", """
+    INSERT INTO Product (artisan_id, name, price, stock_quantity, cultural_motif, image_url, description)
+    SELECT :aid, r.name, r.price, r.stock_quantity, r.cultural_motif, r.image_url, r.description
+    FROM unnest(CAST(:names AS TEXT[]), CAST(:prices AS NUMERIC[]), CAST(:stocks AS INT[]),
+                CAST(:motifs AS TEXT[]), CAST(:images AS TEXT[]), CAST(:descs AS TEXT[]))
+         AS r(name, price, stock_quantity, cultural_motif, image_url, description)
+    RETURNING product_id
+""")
+
+PRODUCT_OWNERS = _statement("product_owners", """
+    SELECT product_id, artisan_id, stock_shards FROM Product WHERE product_id = ANY(CAST(:ids AS INT[]))
+""")
+
+# Set-based batch edit. NULL means "leave unchanged"; stock can be set
+# outright, adjusted by a delta, or both. Rows whose stock would leave the INT
+# range are skipped and simply not returned, as are stock changes to sharded
+# products (see RESHARD_STOCK).
+BATCH_UPDATE_PRODUCTS = _statement("batch_update_products", """
+    UPDATE Product p SET
+        name = COALESCE(u.name, p.name),
+        price = COALESCE(u.price, p.price),
+        stock_quantity = COALESCE(u.stock_quantity, p.stock_quantity) + COALESCE(u.stock_delta, 0),
+        cultural_motif = COALESCE(u.cultural_motif, p.cultural_motif),
+        image_url = COALESCE(u.image_url, p.image_url),
+        description = COALESCE(u.description, p.description)
+    FROM unnest(CAST(:ids AS INT[]), CAST(:names AS TEXT[]), CAST(:prices AS NUMERIC[]),
+                CAST(:stocks AS INT[]), CAST(:deltas AS INT[]), CAST(:motifs AS TEXT[]),
+                CAST(:images AS TEXT[]), CAST(:descs AS TEXT[]))
+         AS u(product_id, name, price, stock_quantity, stock_delta, cultural_motif, image_url, description)
+    WHERE p.product_id = u.product_id
+      AND p.artisan_id = :aid
+      AND CAST(COALESCE(u.stock_quantity, p.stock_quantity) AS BIGINT) + COALESCE(u.stock_delta, 0)
+          BETWEEN 0 AND 2147483647
+      AND (p.stock_shards = 0 OR (u.stock_quantity IS NULL AND u.stock_delta IS NULL))
+    RETURNING p.product_id, total_stock(p)
+""")
+
+# --- Purchase ---
+
+# Stock held by live reservations is not for sale, so every purchase path
+# checks stock_quantity - reserved_quantity
+LOCK_PRODUCT_FOR_PURCHASE = _statement("lock_product_for_purchase", """
+    SELECT product_id, price, stock_quantity - reserved_quantity AS available, artisan_id, stock_shards
+    FROM Product
+    WHERE product_id = :pid
+    FOR UPDATE NOWAIT
+""")
+
+INSERT_ORDER = _statement("insert_order", """
+    INSERT INTO "Order" (customer_id, order_date, status)
+    VALUES (:cid, :date, 'Pending Shipment')
+    RETURNING order_id;
+""")
+
+INSERT_TRANSACTION = _statement("insert_transaction", """
+    INSERT INTO "Transaction" (transaction_id, order_id, amount, payment_method, transaction_date)
+    VALUES (:tid, :oid, :amount, :method, :date);
+""")
+
+INSERT_ORDER_ITEM = _statement("insert_order_item", """
+    INSERT INTO OrderItem (order_id, product_id, quantity, price)
+    VALUES (:oid, :pid, :qty, :price);
+""")
+
+DECREMENT_STOCK = _statement("decrement_stock", """
+    UPDATE Product SET stock_quantity = stock_quantity - :qty WHERE product_id = :pid
+""")
+
+# --- Atomic Purchase ---
+
+# Order, order item and transaction for the stock claimed by a preceding
+# `claimed` CTE (product_id, price, artisan_id). Nothing is written when the
+# claim matched no row.
+_RECORD_CLAIMED_PURCHASE = """
+    , new_order AS (
+        INSERT INTO "Order" (customer_id, order_date, status)
+        SELECT :cid, :date, 'Pending Shipment' FROM claimed
+        RETURNING order_id
+    ), new_item AS (
+        INSERT INTO OrderItem (order_id, product_id, quantity, price)
+        SELECT o.order_id, c.product_id, :qty, c.price FROM new_order o, claimed c
+    ), new_transaction AS (
+        INSERT INTO "Transaction" (transaction_id, order_id, amount, payment_method, transaction_date)
+        SELECT :tid, o.order_id, c.price * :qty, :method, :date FROM new_order o, claimed c
+    )
+    SELECT o.order_id, c.price::float8 AS price, (c.price * :qty)::float8 AS total_amount, c.artisan_id
+    FROM new_order o, claimed c
+"""
+
+# The whole purchase in one statement. The conditional UPDATE claims the stock
+# (a concurrent buyer waits on the row and then re-checks the condition, so
+# nobody is refused while stock remains). No row comes back when the product
+# is missing, short or sharded, and the row lock is held only until the
+# commit that immediately follows.
+PURCHASE_ATOMIC = _statement("purchase_atomic", """
+    WITH claimed AS (
+        UPDATE Product
+        SET stock_quantity = stock_quantity - :qty
+        WHERE product_id = :pid AND stock_shards = 0
+          AND stock_quantity - reserved_quantity >= :qty
+        RETURNING product_id, price, artisan_id
+    )""" + _RECORD_CLAIMED_PURCHASE)
+
+# Sharded products (add_stock_shards.sql). The first statement takes the whole
+# quantity from one slot, starting at a random :start and skipping slots
+# other buyers hold, so concurrent purchases do not queue. The Product row is
+# only read, and this fast path only runs while nothing on it is reserved.
+PURCHASE_FROM_SLOT = _statement("purchase_from_slot", """
+    WITH pick AS (
+        SELECT slot FROM ProductStockSlot
+        WHERE product_id = :pid AND quantity >= :qty
+          AND EXISTS (SELECT 1 FROM Product
+                      WHERE product_id = :pid AND reserved_quantity = 0)
+        ORDER BY slot < :start, slot
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ), taken AS (
+        UPDATE ProductStockSlot s SET quantity = s.quantity - :qty
+        FROM pick
+        WHERE s.product_id = :pid AND s.slot = pick.slot
+        RETURNING s.product_id
+    ), claimed AS (
+        SELECT p.product_id, p.price, p.artisan_id
+        FROM Product p JOIN taken t ON t.product_id = p.product_id
+    )""" + _RECORD_CLAIMED_PURCHASE)
+
+# Fallback when no single free slot holds enough: lock every slot in order
+# and take the quantity across them, if their sum less the reserved quantity
+# covers it.
+PURCHASE_FROM_SLOTS = _statement("purchase_from_slots", """
+    WITH slots AS (
+        SELECT slot, quantity FROM ProductStockSlot
+        WHERE product_id = :pid
+        ORDER BY slot
+        FOR UPDATE
+    ), running AS (
+        SELECT slot, quantity, SUM(quantity) OVER (ORDER BY slot) - quantity AS before
+        FROM slots
+    ), taken AS (
+        UPDATE ProductStockSlot s SET quantity = s.quantity - LEAST(r.quantity, :qty - r.before)
+        FROM running r
+        WHERE s.product_id = :pid AND s.slot = r.slot AND r.before < :qty
+          AND (SELECT SUM(quantity) FROM slots)
+              - (SELECT reserved_quantity FROM Product WHERE product_id = :pid) >= :qty
+        RETURNING s.product_id
+    ), claimed AS (
+        SELECT DISTINCT p.product_id, p.price, p.artisan_id
+        FROM Product p JOIN taken t ON t.product_id = p.product_id
+    )""" + _RECORD_CLAIMED_PURCHASE)
+
+# Moves a product's whole stock (or :stock, when given) into :shards evenly
+# filled slots, or back into stock_quantity when :shards is 0. Returns no row,
+# and changes nothing, while the product has live reservations: those are
+# redeemed from stock_quantity, which sharding empties.
+RESHARD_STOCK = _statement("reshard_stock", """
+    WITH product AS (
+        SELECT product_id, stock_quantity, stock_shards
+        FROM Product
+        WHERE product_id = :pid AND reserved_quantity = 0
+        FOR UPDATE
+    ), current_slots AS (
+        SELECT quantity FROM ProductStockSlot
+        WHERE product_id = :pid
+        FOR UPDATE
+    ), total AS (
+        SELECT COALESCE(CAST(:stock AS INT),
+                        CASE WHEN p.stock_shards > 0
+                             THEN (SELECT COALESCE(SUM(quantity), 0) FROM current_slots)::int
+                             ELSE p.stock_quantity
+                        END) AS quantity
+        FROM product p
+    ), dropped AS (
+        DELETE FROM ProductStockSlot
+        WHERE product_id = :pid AND slot >= :shards AND EXISTS (SELECT 1 FROM product)
+    ), slots AS (
+        INSERT INTO ProductStockSlot (product_id, slot, quantity)
+        SELECT p.product_id, g.slot,
+               t.quantity / :shards + CASE WHEN g.slot < t.quantity % :shards THEN 1 ELSE 0 END
+        FROM product p, total t, generate_series(0, :shards - 1) AS g(slot)
+        ON CONFLICT (product_id, slot) DO UPDATE SET quantity = EXCLUDED.quantity
+    )
+    UPDATE Product p
+    SET stock_shards = :shards,
+        stock_quantity = CASE WHEN :shards > 0 THEN 0 ELSE t.quantity END
+    FROM total t
+    WHERE p.product_id = :pid
+    RETURNING t.quantity
+""")
+
+# Explains an empty PURCHASE_ATOMIC result: missing, short or sharded product
+PRODUCT_STOCK = _statement("product_stock", """
+    SELECT GREATEST(total_stock(p) - p.reserved_quantity, 0), p.stock_shards
+    FROM Product p
+    WHERE p.product_id = :pid
+""")
+
+# --- Cart Checkout ---
+
+# Bounds how long a checkout waits for rows held by another buyer
+SET_LOCK_TIMEOUT = _statement("set_lock_timeout", """
+    SELECT set_config('lock_timeout', :timeout, true)
+""")
+
+# Rows are locked in product_id order, so two carts sharing products always
+# acquire their locks in the same order and cannot deadlock.
+LOCK_PRODUCTS_FOR_CHECKOUT = _statement("lock_products_for_checkout", """
+    SELECT product_id, price, stock_quantity - reserved_quantity AS available, artisan_id, stock_shards
+    FROM Product
+    WHERE product_id = ANY(CAST(:ids AS INT[]))
+    ORDER BY product_id
+    FOR UPDATE
+""")
+
+INSERT_ORDER_ITEMS = _statement("insert_order_items", """
+    INSERT INTO OrderItem (order_id, product_id, quantity, price)
+    SELECT :oid, u.product_id, u.quantity, u.price
+    FROM unnest(CAST(:pids AS INT[]), CAST(:qtys AS INT[]), CAST(:prices AS NUMERIC[]))
+         AS u(product_id, quantity, price)
+""")
+
+DECREMENT_STOCKS = _statement("decrement_stocks", """
+    UPDATE Product p SET stock_quantity = p.stock_quantity - u.qty
+    FROM unnest(CAST(:pids AS INT[]), CAST(:qtys AS INT[])) AS u(product_id, qty)
+    WHERE p.product_id = u.product_id
+""")
+
+# --- Stock Reservations ---
+# A hold moves quantity into Product.reserved_quantity and records it in
+# StockReservation, in one statement. Expired holds are returned in bulk by
+# the sweeper. Timestamps use LOCALTIMESTAMP, matching the other columns.
+
+PRODUCT_AVAILABILITY = _statement("product_availability", """
+    SELECT p.product_id, total_stock(p) AS stock_quantity, p.reserved_quantity,
+           GREATEST(total_stock(p) - p.reserved_quantity, 0) AS available
+    FROM Product p
+    WHERE p.product_id = ANY(CAST(:ids AS INT[]))
+    ORDER BY p.product_id
+""")
+
+RESERVE_STOCK = _statement("reserve_stock", """
+    WITH held AS (
+        UPDATE Product
+        SET reserved_quantity = reserved_quantity + :qty
+        WHERE product_id = :pid AND stock_quantity - reserved_quantity >= :qty
+        RETURNING product_id
+    )
+    INSERT INTO StockReservation (product_id, customer_id, quantity, expires_at)
+    SELECT product_id, :cid, :qty, LOCALTIMESTAMP + make_interval(secs => :ttl)
+    FROM held
+    RETURNING reservation_id, product_id, quantity, expires_at
+""")
+
+# Drops the buyer's current hold on a product before a new one is placed
+RELEASE_PRODUCT_RESERVATION = _statement("release_product_reservation", """
+    WITH released AS (
+        DELETE FROM StockReservation
+        WHERE customer_id = :cid AND product_id = :pid
+        RETURNING product_id, quantity
+    )
+    UPDATE Product p SET reserved_quantity = p.reserved_quantity - r.quantity
+    FROM released r
+    WHERE p.product_id = r.product_id
+    RETURNING p.product_id
+""")
+
+RELEASE_RESERVATION = _statement("release_reservation", """
+    WITH released AS (
+        DELETE FROM StockReservation
+        WHERE reservation_id = :rid AND customer_id = :cid
+        RETURNING product_id, quantity
+    )
+    UPDATE Product p SET reserved_quantity = p.reserved_quantity - r.quantity
+    FROM released r
+    WHERE p.product_id = r.product_id
+    RETURNING p.product_id
+""")
+
+BUYER_RESERVATIONS = _statement("buyer_reservations", """
+    SELECT r.reservation_id, r.product_id, p.name, r.quantity,
+           p.price::float8 AS price, r.expires_at
+    FROM StockReservation r
+    JOIN Product p ON p.product_id = r.product_id
+    WHERE r.customer_id = :cid AND r.expires_at > LOCALTIMESTAMP
+    ORDER BY r.expires_at
+""")
+
+RESERVATION_STATUS = _statement("reservation_status", """
+    SELECT expires_at > LOCALTIMESTAMP AS live
+    FROM StockReservation
+    WHERE reservation_id = :rid AND customer_id = :cid
+""")
+
+# Converts a live hold into an order: the hold is deleted and its quantity
+# leaves both stock_quantity and reserved_quantity. Returns no row when the
+# hold is missing or expired, or the artisan has since cut stock below it.
+PURCHASE_RESERVATION = _statement("purchase_reservation", """
+    WITH held AS (
+        DELETE FROM StockReservation
+        WHERE reservation_id = :rid AND customer_id = :cid AND expires_at > LOCALTIMESTAMP
+        RETURNING product_id, quantity
+    ), claimed AS (
+        UPDATE Product p
+        SET stock_quantity = p.stock_quantity - h.quantity,
+            reserved_quantity = p.reserved_quantity - h.quantity
+        FROM held h
+        WHERE p.product_id = h.product_id AND p.stock_quantity >= h.quantity
+        RETURNING p.product_id, p.price, p.artisan_id, h.quantity
+    ), new_order AS (
+        INSERT INTO "Order" (customer_id, order_date, status)
+        SELECT :cid, :date, 'Pending Shipment' FROM claimed
+        RETURNING order_id
+    ), new_item AS (
+        INSERT INTO OrderItem (order_id, product_id, quantity, price)
+        SELECT o.order_id, c.product_id, c.quantity, c.price FROM new_order o, claimed c
+    ), new_transaction AS (
+        INSERT INTO "Transaction" (transaction_id, order_id, amount, payment_method, transaction_date)
+        SELECT :tid, o.order_id, c.price * c.quantity, :method, :date FROM new_order o, claimed c
+    )
+    SELECT o.order_id, c.price::float8 AS price, (c.price * c.quantity)::float8 AS total_amount,
+           c.artisan_id, c.product_id, c.quantity
+    FROM new_order o, claimed c
+""")
+
+# Releases up to :batch expired holds. SKIP LOCKED leaves holds that are
+# being converted or released right now, and lets several workers sweep.
+SWEEP_EXPIRED_RESERVATIONS = _statement("sweep_expired_reservations", """
+    WITH expired AS (
+        DELETE FROM StockReservation
+        WHERE reservation_id IN (
+            SELECT reservation_id FROM StockReservation
+            WHERE expires_at <= LOCALTIMESTAMP
+            ORDER BY expires_at
+            LIMIT :batch
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING product_id, quantity
+    ), totals AS (
+        SELECT product_id, SUM(quantity) AS quantity FROM expired GROUP BY product_id
+    ), released AS (
+        UPDATE Product p SET reserved_quantity = p.reserved_quantity - t.quantity
+        FROM totals t
+        WHERE p.product_id = t.product_id
+    )
+    SELECT COUNT(*) FROM expired
+""")
+
+# --- Idempotency Keys ---
+# See idempotency.py. The key row is inserted by the purchase transaction and
+# gets its response before that transaction commits.
+
+IDEMPOTENCY_KEY_LOOKUP = _statement("idempotency_key_lookup", """
+    SELECT endpoint, request_hash, status_code, response
+    FROM IdempotencyKey
+    WHERE user_id = :uid AND idempotency_key = :key
+""")
+
+CLAIM_IDEMPOTENCY_KEY = _statement("claim_idempotency_key", """
+    INSERT INTO IdempotencyKey (user_id, idempotency_key, endpoint, request_hash)
+    VALUES (:uid, :key, :endpoint, :hash)
+    ON CONFLICT (user_id, idempotency_key) DO NOTHING
+    RETURNING 1
+""")
+
+STORE_IDEMPOTENT_RESPONSE = _statement("store_idempotent_response", """
+    UPDATE IdempotencyKey SET status_code = :status, response = :response
+    WHERE user_id = :uid AND idempotency_key = :key
+""")
+
+PURGE_IDEMPOTENCY_KEYS = _statement("purge_idempotency_keys", """
+    WITH purged AS (
+        DELETE FROM IdempotencyKey
+        WHERE (user_id, idempotency_key) IN (
+            SELECT user_id, idempotency_key FROM IdempotencyKey
+            WHERE created_at < LOCALTIMESTAMP - make_interval(secs => :ttl)
+            ORDER BY created_at
+            LIMIT :batch
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM purged
+""")
+
+# --- Artisan Dashboard ---
+
+ARTISAN_EXISTS = _statement("artisan_exists", """
+    SELECT artisan_id FROM Artisan WHERE artisan_id = :uid
+""")
+
+ARTISAN_PRODUCT_COUNT = _statement("artisan_product_count", """
+    SELECT COUNT(*) FROM Product WHERE artisan_id = :aid
+""")
+
+# Calculate sales from OrderItem table
+ARTISAN_SALES_SUMMARY = _statement("artisan_sales_summary", """
+    SELECT
+        COALESCE(SUM(t.amount), 0) as total_sales,
+        COUNT(DISTINCT CASE WHEN o.status = 'Pending Shipment' THEN o.order_id END) as awaiting_dispatch,
+        COUNT(DISTINCT CASE WHEN o.status = 'Shipped' THEN o.order_id END) as in_transit,
+        COUNT(DISTINCT CASE WHEN o.status = 'Delivered' THEN o.order_id END) as completed_orders
+    FROM Product p
+    LEFT JOIN OrderItem oi ON p.product_id = oi.product_id
+    LEFT JOIN "Order" o ON oi.order_id = o.order_id
+    LEFT JOIN "Transaction" t ON o.order_id = t.order_id
+    WHERE p.artisan_id = :aid
+""")
+
+# Orders for this artisan's products with shipment info
+ARTISAN_ORDERS = _statement("artisan_orders", """
+    SELECT
+        o.order_id,
+        o.order_date,
+        o.status,
+        p.name,
+        oi.quantity,
+        COALESCE(t.amount,0)::float8 as amount,
+        s.courier_service,
+        s.shipped_date,
+        s.tracking_number
+    FROM Product p
+    JOIN OrderItem oi ON p.product_id = oi.product_id
+    JOIN "Order" o ON oi.order_id = o.order_id
+    LEFT JOIN "Transaction" t ON o.order_id = t.order_id
+    LEFT JOIN Shipment s ON o.order_id = s.order_id
+    WHERE p.artisan_id = :aid
+    ORDER BY o.order_date DESC
+    LIMIT 50
+""")
+
+# --- Startup Warm-up ---
+# Read-only statements executed once per pre-warmed connection so asyncpg
+# prepares them before real traffic arrives. Parameters match nothing.
+WARMUP = (
+    (AUTHENTICATE_USER, {"email": ""}),
+    (PRINCIPAL_BY_ID, {"uid": 0}),
+    (PRODUCT_LISTING, {"limit": 1}),
+    (PRODUCT_SEARCH, {"q": "", "limit": 1, "offset": 0}),
+    (ARTISAN_EXISTS, {"uid": 0}),
+    (ARTISAN_PRODUCT_COUNT, {"aid": 0}),
+    (ARTISAN_SALES_SUMMARY, {"aid": 0}),
+    (ARTISAN_ORDERS, {"aid": 0}),
+)
+
+
+# --- JSON Built In Postgres ---
+# For the heavier financial lists Postgres renders the whole response body
+# with json_agg/json_build_object. The ::text cast keeps the driver from
+# parsing it, so the bytes go straight to the client.
+
+ARTISAN_WALLET_JSON = _statement("artisan_wallet_json", """
+    WITH tx AS (
+        SELECT t.transaction_id, t.order_id, t.amount::float8 AS amount, t.transaction_date
+        FROM Product p
+        JOIN OrderItem oi ON p.product_id = oi.product_id
+        JOIN "Order" o ON oi.order_id = o.order_id
+        JOIN "Transaction" t ON o.order_id = t.order_id
+        WHERE p.artisan_id = :aid
+    ), totals AS (
+        SELECT COALESCE(SUM(amount), 0) AS earned FROM tx
+    )
+    SELECT json_build_object(
+        'balance', totals.earned - totals.earned * CAST(:rate AS float8),
+        'total_earned', totals.earned,
+        'commission_paid', totals.earned * CAST(:rate AS float8),
+        'pending_payout', totals.earned - totals.earned * CAST(:rate AS float8),
+        'transactions', COALESCE((
+            SELECT json_agg(json_build_object(
+                'transaction_id', transaction_id,
+                'order_id', order_id,
+                'amount', amount,
+                'commission', amount * CAST(:rate AS float8),
+                'net', amount * (1 - CAST(:rate AS float8)),
+                'date', transaction_date
+            ) ORDER BY transaction_date DESC)
+            FROM tx), '[]')
+    )::text
+    FROM totals
+""")
+
+AUDIT_LOGS_JSON = _statement("audit_logs_json", """
+    SELECT COALESCE(json_agg(json_build_object(
+        'transaction_id', transaction_id,
+        'order_id', order_id,
+        'amount', amount::float8,
+        'payment_method', payment_method,
+        'transaction_date', transaction_date
+    ) ORDER BY transaction_date DESC), '[]')::text
+    FROM (
+        SELECT transaction_id, order_id, amount, payment_method, transaction_date
+        FROM "Transaction"
+        ORDER BY transaction_date DESC
+        LIMIT 100
+    ) t
+""")
+
+ALL_SELLERS_FINANCIAL_JSON = _statement("all_sellers_financial_json", """
+    SELECT COALESCE(json_agg(json_build_object(
+        'artisan_id', artisan_id,
+        'email', email,
+        'registration_date', registration_date,
+        'total_products', total_products,
+        'total_revenue', total_revenue,
+        'marketplace_commission', total_revenue * CAST(:rate AS float8),
+        'net_earnings', total_revenue * (1 - CAST(:rate AS float8)),
+        'total_orders', total_orders
+    ) ORDER BY total_revenue DESC), '[]')::text
+    FROM (
+        SELECT
+            a.artisan_id,
+            u.email,
+            u.registration_date,
+            COUNT(DISTINCT p.product_id) as total_products,
+            COALESCE(SUM(t.amount), 0)::float8 as total_revenue,
+            COUNT(DISTINCT o.order_id) as total_orders
+        FROM Artisan a
+        JOIN "User" u ON a.artisan_id = u.user_id
+        LEFT JOIN Product p ON a.artisan_id = p.artisan_id
+        LEFT JOIN OrderItem oi ON p.product_id = oi.product_id
+        LEFT JOIN "Order" o ON oi.order_id = o.order_id
+        LEFT JOIN "Transaction" t ON o.order_id = t.order_id
+        WHERE u.is_active = TRUE
+        GROUP BY a.artisan_id, u.email, u.registration_date
+    ) s
+""")
@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from pathlib import Path
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# --- Front-end Asset Settings ---
+# The HTML pages and translation script are read once, compressed once with
+# the slowest (smallest) settings, and then served from memory with content
+# negotiation. Browsers revalidate after STATIC_CACHE_MAX_AGE seconds and
+# get 304 while the file is unchanged.
+STATIC_CACHE_MAX_AGE = int(os.getenv("STATIC_CACHE_MAX_AGE", "300"))
+FRONTEND_ASSETS = ("login.html", "buyer.html", "artisan.html",
+                   "admin.html", "lang_translations.js")
+
+
+class PrecompressedAsset:
+    """One front-end file with its identity, gzip and brotli encodings."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime = path.stat().st_mtime
+        body = path.read_bytes()
+        self.media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type.endswith("javascript"):
+            self.media_type += "; charset=utf-8"
+        self.digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.encodings = {"identity": body,
+                          "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(body, quality=11)
+
+    def etag(self, encoding: str) -> str:
+        # Each encoding is a different representation, so it gets its own tag
+        suffix = "" if encoding == "identity" else f"-{encoding}"
+        return f'"{self.digest}{suffix}"'
+
+
+def choose_encoding(accept_encoding: str, available) -> str:
+    """Smallest encoding the client accepts (br, then gzip, then identity)."""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return "identity"
+
+
+class StaticAssetStore:
+    """In-memory, precompressed copies of FRONTEND_ASSETS."""
+
+    def __init__(self, root: Path, names):
+        self.root = root
+        self.names = tuple(names)
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def build(self):
+        """Load and compress every asset. Called at startup."""
+        for name in self.names:
+            self._load(name)
+
+    def _load(self, name: str) -> PrecompressedAsset:
+        asset = PrecompressedAsset(self.root / name)
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def get(self, name: str) -> PrecompressedAsset:
+        asset = self._assets.get(name)
+        # Rebuilt when the file changes on disk (e.g. during development)
+        if asset is None or asset.path.stat().st_mtime != asset.mtime:
+            asset = self._load(name)
+        return asset
+
+    def response(self, name: str, request: Request) -> Response:
+        asset = self.get(name)
+        encoding = choose_encoding(
+            request.headers.get("accept-encoding", ""), asset.encodings)
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": f"public, max-age={STATIC_CACHE_MAX_AGE}, must-revalidate",
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+        return Response(content=asset.encodings[encoding],
+                        media_type=asset.media_type, headers=headers)
+
+
+static_assets = StaticAssetStore(Path(__file__).resolve().parent, FRONTEND_ASSETS)